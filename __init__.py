@@ -28,7 +28,8 @@ if __name__ == "__main__":
     #experiments.run_experiment_4(test_on_sample=True)
     #experiments.run_experiment_5(test_on_sample=True)
     #experiments.run_experiment_6(test_on_sample=True)
+    #experiments.run_experiment_7(test_on_sample=True)
 
-    rag = llm(collection=collection, indexes=indexes)
+    rag = llm(collection=collection, indexes=indexes, warmup_query="warm up")
     answer = rag.answer_query("When did the king of spain died?")
     print(answer)
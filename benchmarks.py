@@ -0,0 +1,601 @@
+import json
+import os
+import platform
+import shutil
+import subprocess
+import threading
+import time
+from pathlib import Path
+from constants import INDEXES_FOLDER, EXPANSION_FOLDER
+from functions import keywords_extractor, keywords_extractor_batch, clear_keywords_models
+
+def benchmark_keywords_extraction(texts: list[str], max_keywords=3, method='rake', batch_size=256) -> dict:
+    # Old path: a new model for every text, as keywords_extractor did before the model registry
+    start = time.perf_counter()
+    old_keywords = []
+    for text in texts:
+        clear_keywords_models()
+        old_keywords.append(keywords_extractor(text, max_keywords, method))
+    old_time = time.perf_counter() - start
+
+    # New path: one model for the whole run, texts embedded in batches
+    clear_keywords_models()
+    start = time.perf_counter()
+    new_keywords = keywords_extractor_batch(texts, max_keywords, method, batch_size)
+    new_time = time.perf_counter() - start
+
+    mismatches = sum(sorted(old) != sorted(new) for old, new in zip(old_keywords, new_keywords))
+    results = {
+        "texts": len(texts),
+        "method": method,
+        "old_texts_per_second": len(texts) / old_time,
+        "new_texts_per_second": len(texts) / new_time,
+        "speedup": old_time / new_time,
+        "mismatches": mismatches,
+    }
+
+    print(f"Keyword extraction benchmark ({method}, {len(texts)} texts)")
+    print(f"Per-call models: {results['old_texts_per_second']:.1f} texts/s")
+    print(f"Batched:         {results['new_texts_per_second']:.1f} texts/s")
+    print(f"Speedup: {results['speedup']:.1f}x, mismatching outputs: {mismatches}")
+    return results
+
+def benchmark_document_loading(collection) -> dict:
+    # Peak Python memory of the DataFrame path (load + records copy, as the indexers used to do) against streaming
+    import tracemalloc
+
+    tracemalloc.start()
+    collection.load_documents()
+    records = collection.corpus_dataframe.copy().to_dict(orient="records")
+    _, dataframe_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del records
+
+    tracemalloc.start()
+    documents = 0
+    for _ in collection.iter_documents():
+        documents += 1
+    _, streaming_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    results = {
+        "documents": documents,
+        "dataframe_peak_mb": dataframe_peak / 2**20,
+        "streaming_peak_mb": streaming_peak / 2**20,
+    }
+    print(f"Document loading benchmark ({documents} documents)")
+    print(f"DataFrame path peak memory: {results['dataframe_peak_mb']:.1f} MB")
+    print(f"Streaming path peak memory: {results['streaming_peak_mb']:.1f} MB")
+    return results
+
+def normalise_run(run) -> dict:
+    # Ranking of every query with ties ordered by docno, so runs from different builds can be compared
+    rankings = {}
+    for qid, group in run.groupby("qid"):
+        ranking = sorted(zip(group["docno"], group["score"].round(4)), key=lambda pair: (-pair[1], pair[0]))
+        rankings[qid] = ranking
+    return rankings
+
+def benchmark_index_threads(collection, thread_counts=(1, 2, 4), index_type="basic", streaming=False, queries=None, benchmark_folder="indexes_benchmark") -> dict:
+    # Build the same index with every thread count, then check the BM25 rankings against the first build
+    import pyterrier as pt
+    from indexes import BenchmarkIndex
+
+    builders = {
+        "basic": ("create_basic_index", "load_basic_index", "basic_index"),
+        "keywords_expanded": ("create_keywords_expanded_index", "load_keywords_expanded_index", "keywords_expanded_index"),
+        "two_fields": ("create_two_fields_index", "load_two_fields_index", "two_fields_index"),
+    }
+    if index_type not in builders:
+        raise ValueError(f"index_type must be one of {list(builders)}")
+    create, load, attribute = builders[index_type]
+
+    if queries is None:
+        queries = collection.queries_sample if hasattr(collection, "queries_sample") else collection.queries
+
+    results = {"index_type": index_type, "queries": len(queries), "builds": {}}
+    reference = None
+    for threads in thread_counts:
+        folder = Path(benchmark_folder) / f"{index_type}_threads_{threads}"
+        if folder.exists():
+            shutil.rmtree(folder)
+        indexes = BenchmarkIndex(collection, indexes_folder=folder)
+
+        # The keyword expansion is not part of the indexing cost, reuse the one already on disk
+        expansion_path = Path(INDEXES_FOLDER) / EXPANSION_FOLDER
+        if index_type != "basic" and expansion_path.exists():
+            (folder / EXPANSION_FOLDER).symlink_to(expansion_path.resolve(), target_is_directory=True)
+
+        start = time.perf_counter()
+        getattr(indexes, create)(streaming=streaming, threads=threads)
+        build_time = time.perf_counter() - start
+
+        getattr(indexes, load)()
+        index = getattr(indexes, attribute)
+        rankings = normalise_run(pt.terrier.Retriever(index, wmodel="BM25").transform(queries))
+        if reference is None:
+            reference = rankings
+        identical = sum(rankings.get(qid) == ranking for qid, ranking in reference.items())
+
+        results["builds"][threads] = {
+            "build_seconds": build_time,
+            "documents": index.getCollectionStatistics().getNumberOfDocuments(),
+            "identical_rankings": identical,
+        }
+        print(f"{index_type} index, {threads} thread(s): {build_time:.1f}s, {identical}/{len(reference)} queries with identical BM25 rankings")
+    return results
+
+def benchmark_dense_scorer_threads(collection, threads=4, queries=None, depth=100, benchmark_folder="indexes_benchmark") -> dict:
+    # BM25 candidates of a basic index built with threads>1 re-scored by the dense index. Every score has to be
+    # the dot product of the query with the vector of its docno: dense_scorer() drops the Terrier docids,
+    # the plain FlexIndex scorer uses them as vector positions
+    import numpy as np
+    from indexes import BenchmarkIndex
+
+    if queries is None:
+        queries = collection.queries_sample if hasattr(collection, "queries_sample") else collection.queries
+
+    folder = Path(benchmark_folder) / f"basic_threads_{threads}"
+    if folder.exists():
+        shutil.rmtree(folder)
+    threaded = BenchmarkIndex(collection, indexes_folder=folder)
+    threaded.create_basic_index(threads=threads)
+    threaded.load_basic_index()
+    indexes = BenchmarkIndex(collection)
+    indexes.load_dense_index()
+    dense_index = getattr(indexes.dense_index, "base", indexes.dense_index)
+    delta_docnos = {docno for _, docnos in getattr(indexes.dense_index, "deltas", []) for docno in docnos}
+
+    candidates = (threaded.retriever("basic_index", wmodel="BM25", cached=False) % depth).transform(queries)
+    candidates = indexes.query_encoder(cached=False).transform(candidates[~candidates["docno"].isin(delta_docnos)])
+    expected = dense_index.vec_loader().transform(candidates.drop(columns=["docid"]))
+    expected["expected"] = np.einsum("ij,ij->i", np.stack(expected["query_vec"]), np.stack(expected["doc_vec"]))
+    expected = expected[["qid", "docno", "expected"]]
+
+    results = {"threads": threads, "queries": len(queries), "candidates": len(candidates)}
+    for name, scorer in [("dense_scorer", indexes.dense_scorer()), ("docid_scorer", dense_index.scorer())]:
+        scored = scorer.transform(candidates).merge(expected, on=["qid", "docno"])
+        results[f"{name}_mismatches"] = int((~np.isclose(scored["score"], scored["expected"], rtol=1e-4, atol=1e-4)).sum())
+    print(f"Dense scores of {len(candidates)} BM25 candidates from a {threads} thread basic index: "
+          f"{results['dense_scorer_mismatches']} wrong by docno, {results['docid_scorer_mismatches']} wrong by Terrier docid")
+    return results
+
+def latency_summary(latencies: list[float]) -> dict:
+    import numpy as np
+    latencies = np.asarray(latencies)
+    return {
+        "mean_seconds": float(latencies.mean()),
+        "p50_seconds": float(np.percentile(latencies, 50)),
+        "p95_seconds": float(np.percentile(latencies, 95)),
+        "p99_seconds": float(np.percentile(latencies, 99)),
+    }
+
+def folder_size(path) -> int:
+    return sum(file.stat().st_size for file in Path(path).rglob("*") if file.is_file())
+
+def benchmark_text_fetching(indexes, run) -> dict:
+    # Text lookup for a run (e.g. bm25 % 100) from the document store against pt.text.get_text on the Terrier meta index,
+    # plus the disk size of the two. The meta path is only timed when the basic index was built with text_meta=True
+    import pyterrier as pt
+    from docstore import DocumentText
+    from constants import BASIC_INDEX_NAME, DOCUMENT_STORE_NAME
+
+    if not (hasattr(indexes, "basic_index") and hasattr(indexes, "document_store")):
+        raise RuntimeError("basic_index and document_store must be loaded, try load_basic_index()")
+    run = run.drop(columns=["text"], errors="ignore")
+    results = {
+        "documents": len(run),
+        "store_mb": folder_size(indexes.indexes_folder / DOCUMENT_STORE_NAME) / 2**20,
+        "basic_index_mb": folder_size(indexes.indexes_folder / BASIC_INDEX_NAME) / 2**20,
+    }
+
+    start = time.perf_counter()
+    store_texts = DocumentText(indexes.document_store).transform(run)["text"].tolist()
+    results["store_docs_per_second"] = len(run) / (time.perf_counter() - start)
+
+    if "text" in list(indexes.basic_index.getMetaIndex().getKeys()):
+        start = time.perf_counter()
+        meta_texts = pt.text.get_text(indexes.basic_index, "text").transform(run)["text"].tolist()
+        results["meta_docs_per_second"] = len(run) / (time.perf_counter() - start)
+        results["speedup"] = results["store_docs_per_second"] / results["meta_docs_per_second"]
+        results["mismatches"] = sum(store != meta for store, meta in zip(store_texts, meta_texts))
+
+    print(f"Text fetching benchmark ({len(run)} documents)")
+    print(f"Document store: {results['store_docs_per_second']:.0f} docs/s, {results['store_mb']:.1f} MB on disk (basic index {results['basic_index_mb']:.1f} MB)")
+    if "meta_docs_per_second" in results:
+        print(f"Terrier meta:   {results['meta_docs_per_second']:.0f} docs/s")
+        print(f"Speedup: {results['speedup']:.1f}x, mismatching texts: {results['mismatches']}")
+    return results
+
+def benchmark_rag_latency(rag, questions: list[str]) -> dict:
+    # Per-question retrieval latency when the pipeline is rebuilt for every question (as before) and when it is kept warm.
+    # The LLM call is left out, it does not depend on how the pipeline is built. Both loops use the uncached first stage
+    # and MonoT5, the warm loop repeats the questions of the cold one and would otherwise only measure cache hits
+    from pipelines import load_monot5
+
+    def build_pipeline():
+        first_stage = rag.first_stage_retriever(rag.first_stage, rag.candidates, rag.fusion, cached=False)
+        return rag.rerank_pipeline(first_stage, load_monot5(16, rag.monot5_cpu_mode, **rag.monot5_options))
+
+    cold = []
+    for question in questions:
+        start = time.perf_counter()
+        build_pipeline().search(question)
+        cold.append(time.perf_counter() - start)
+
+    pipeline = build_pipeline()
+    warm = []
+    for question in questions:
+        start = time.perf_counter()
+        pipeline.search(question)
+        warm.append(time.perf_counter() - start)
+
+    results = {"questions": len(questions), "rebuilt_pipeline": latency_summary(cold), "warm_pipeline": latency_summary(warm)}
+    print(f"RAG retrieval latency ({len(questions)} questions)")
+    for name in ["rebuilt_pipeline", "warm_pipeline"]:
+        summary = results[name]
+        print(f"{name}: mean {summary['mean_seconds']:.2f}s, p50 {summary['p50_seconds']:.2f}s, p95 {summary['p95_seconds']:.2f}s")
+    return results
+
+def benchmark_dense_ann(indexes, queries, k=10, settings=None) -> dict:
+    # QPS and recall@k of approximate dense retrieval, against the exhaustive scan as ground truth.
+    # Queries are embedded once up front, so only the search itself is timed.
+    if settings is None:
+        settings = [
+            {"mode": "ivf", "n_probe": 4},
+            {"mode": "ivf", "n_probe": 16},
+            {"mode": "ivf", "n_probe": 64},
+            {"mode": "hnsw", "ef_search": 32},
+            {"mode": "hnsw", "ef_search": 128},
+        ]
+    encoded = indexes.query_encoder().transform(queries)
+
+    def timed_run(retriever):
+        start = time.perf_counter()
+        run = retriever.transform(encoded)
+        return run, time.perf_counter() - start
+
+    def top_docnos(run):
+        run = run[run["rank"] < k]
+        return {qid: set(group["docno"]) for qid, group in run.groupby("qid")}
+
+    exhaustive, exhaustive_time = timed_run(indexes.dense_retriever("exhaustive", num_results=k))
+    truth = top_docnos(exhaustive)
+    results = {"queries": len(queries), "k": k, "exhaustive_qps": len(queries) / exhaustive_time, "settings": []}
+    print(f"Dense ANN benchmark ({len(queries)} queries, recall@{k})")
+    print(f"exhaustive: {results['exhaustive_qps']:.1f} queries/s")
+
+    for setting in settings:
+        params = dict(setting)
+        mode = params.pop("mode")
+        retriever = indexes.dense_retriever(mode, num_results=k, **params)
+        # The first call builds or reads the FAISS structure, warm it up before timing
+        retriever.transform(encoded.head(1))
+        run, run_time = timed_run(retriever)
+        found = top_docnos(run)
+        recall = sum(len(found.get(qid, set()) & docnos) / len(docnos) for qid, docnos in truth.items() if docnos) / max(len(truth), 1)
+        result = {**setting, "qps": len(queries) / run_time, "speedup": exhaustive_time / run_time, f"recall@{k}": recall}
+        results["settings"].append(result)
+        print(f"{setting}: {result['qps']:.1f} queries/s ({result['speedup']:.1f}x), recall@{k} {recall:.3f}")
+    return results
+
+def benchmark_hybrid_candidates(rag, queries, qrels, candidate_depths=(100, 50, 20), fusion="rrf") -> dict:
+    # Effectiveness and latency of the RAG reranking pipeline with BM25 or hybrid candidates,
+    # at decreasing numbers of documents sent to MonoT5.
+    # Nothing is read from the run, embedding or MonoT5 caches, later settings would otherwise reuse the scores of earlier ones
+    import pyterrier as pt
+    from constants import EVAL_METRICS
+    from pipelines import load_monot5
+
+    monoT5 = load_monot5(16, rag.monot5_cpu_mode, **rag.monot5_options)
+    runs, names, latencies = [], [], {}
+    for first_stage in ["bm25", "hybrid"]:
+        for candidates in candidate_depths:
+            pipeline = rag.rerank_pipeline(rag.first_stage_retriever(first_stage, candidates, fusion, cached=False), monoT5)
+            start = time.perf_counter()
+            runs.append(pipeline.transform(queries))
+            name = f"{first_stage}_{candidates}"
+            latencies[name] = (time.perf_counter() - start) / len(queries)
+            names.append(name)
+
+    table = pt.Experiment(runs, queries, qrels, EVAL_METRICS, names=names)
+    table["seconds_per_query"] = [latencies[name] for name in table["name"]]
+    print(f"RAG first stage benchmark ({len(queries)} queries, {fusion} fusion)")
+    print(table)
+    return {"queries": len(queries), "fusion": fusion, "results": table.to_dict(orient="records")}
+
+def benchmark_monot5_cpu(run, settings=None, batch_size=16) -> dict:
+    # Passages per second of the MonoT5 CPU modes on a run with query and text columns (e.g. bm25 % 100 >> get_text),
+    # and how closely their scores and rankings follow the float32 MonoT5ReRanker
+    import numpy as np
+    from scipy.stats import kendalltau
+    from pipelines import load_monot5
+
+    if settings is None:
+        settings = [
+            {"quantize": False},
+            {"quantize": True},
+        ]
+
+    def timed_transform(reranker):
+        start = time.perf_counter()
+        results = reranker.transform(run)
+        return results, time.perf_counter() - start
+
+    load_start = time.perf_counter()
+    reference_model = load_monot5(batch_size)
+    reference_load = time.perf_counter() - load_start
+    reference, reference_time = timed_transform(reference_model)
+    del reference_model
+
+    results = {
+        "passages": len(run),
+        "reference": {"load_seconds": reference_load, "passages_per_second": len(run) / reference_time},
+        "settings": [],
+    }
+    print(f"MonoT5 CPU benchmark ({len(run)} passages)")
+    print(f"float32 MonoT5ReRanker: {results['reference']['passages_per_second']:.1f} passages/s")
+
+    keys = ["qid", "docno"]
+    for setting in settings:
+        load_start = time.perf_counter()
+        reranker = load_monot5(batch_size, cpu_mode=True, **setting)
+        load_time = time.perf_counter() - load_start
+        scored, scored_time = timed_transform(reranker)
+        del reranker
+
+        merged = reference[keys + ["score", "rank"]].merge(scored[keys + ["score", "rank"]], on=keys, suffixes=("_reference", "_cpu"))
+        taus, top1 = [], []
+        for _, group in merged.groupby("qid"):
+            if len(group) > 1:
+                taus.append(kendalltau(group["score_reference"], group["score_cpu"]).statistic)
+            top1.append(group.loc[group["rank_reference"].idxmin(), "rank_cpu"] == 0)
+
+        result = {
+            **setting,
+            "load_seconds": load_time,
+            "passages_per_second": len(run) / scored_time,
+            "speedup": reference_time / scored_time,
+            "max_abs_score_difference": float((merged["score_reference"] - merged["score_cpu"]).abs().max()),
+            "mean_kendall_tau": float(np.nanmean(taus)) if taus else 1.0,
+            "top1_agreement": float(np.mean(top1)),
+        }
+        results["settings"].append(result)
+        print(f"{setting}: {result['passages_per_second']:.1f} passages/s ({result['speedup']:.1f}x), "
+              f"kendall tau {result['mean_kendall_tau']:.3f}, top 1 agreement {result['top1_agreement']:.3f}")
+    return results
+
+class PeakMemory():
+    # Highest resident set size of the process (JVM and torch included) while the block runs, sampled every interval seconds.
+    # increase is the peak over the RSS at the start of the block: the process peak never goes down, so it would
+    # carry the peaks of everything that ran before. Memory freed earlier but kept by the allocators is reused for free
+    def __init__(self, interval=0.01):
+        import psutil
+        self.process = psutil.Process()
+        self.interval = interval
+        self.baseline = 0
+        self.peak = 0
+
+    def sample(self):
+        while not self.stopped.wait(self.interval):
+            self.peak = max(self.peak, self.process.memory_info().rss)
+
+    def __enter__(self):
+        self.baseline = self.peak = self.process.memory_info().rss
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.thread.join()
+        self.peak = max(self.peak, self.process.memory_info().rss)
+
+    @property
+    def increase(self) -> int:
+        return self.peak - self.baseline
+
+def git_commit() -> str:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return commit + ("-dirty" if dirty else "")
+
+def benchmark_pipeline(pipeline, topics) -> dict:
+    # One query at a time for the latency percentiles, then all of them in one transform for the batch throughput.
+    # The first query is run once beforehand, lazy initialisation is part of the load time, not of the latency
+    pipeline.transform(topics.head(1))
+    with PeakMemory() as memory:
+        latencies = []
+        for i in range(len(topics)):
+            start = time.perf_counter()
+            pipeline.transform(topics.iloc[[i]])
+            latencies.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        pipeline.transform(topics)
+        batch_seconds = time.perf_counter() - start
+    return {
+        **latency_summary(latencies),
+        "sequential_qps": len(topics) / sum(latencies),
+        "batch_qps": len(topics) / batch_seconds,
+        "rss_before_mb": memory.baseline / 2**20,
+        "peak_rss_increase_mb": memory.increase / 2**20,
+    }
+
+def benchmark_pipelines(experiments, rag=None, experiment_ids=(1, 2, 3, 4, 5, 6), queries=None, max_queries=100) -> dict:
+    # Latency, throughput, memory and load time of the pipelines of experiments 1-6 and of the RAG retriever.
+    # Nothing is read from the run, embedding or MonoT5 caches. Every report is written as
+    # results/experiment_N/benchmark_<commit>_<n>_queries.json (results/rag/ for the RAG retriever),
+    # with the commit and the machine in it so numbers from different commits can be compared.
+    from caches import make_key
+    from pipelines import load_monot5
+
+    collection = experiments.collection
+    if queries is None:
+        queries = collection.queries_sample if hasattr(collection, "queries_sample") else collection.queries
+    queries = queries.head(max_queries).reset_index(drop=True)
+
+    commit = git_commit()
+    metadata = {
+        "commit": commit,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "queries": len(queries),
+        "queries_key": make_key(list(queries["qid"])),
+        "machine": {"platform": platform.platform(), "python": platform.python_version(), "cpus": os.cpu_count()},
+    }
+
+    def save(report, folder):
+        save_dir = experiments.results_folder / folder
+        save_dir.mkdir(parents=True, exist_ok=True)
+        path = save_dir / f"benchmark_{commit}_{len(queries)}_queries.json"
+        with open(path, "w") as file:
+            json.dump(report, file, indent=2)
+        print("Benchmark saved to:", path)
+
+    def print_report(title, report):
+        print(f"{title} (load {report['load_seconds']:.1f}s)")
+        for name, result in report["pipelines"].items():
+            print(f"  {name}: p50 {result['p50_seconds'] * 1000:.0f}ms, p95 {result['p95_seconds'] * 1000:.0f}ms, "
+                  f"p99 {result['p99_seconds'] * 1000:.0f}ms, batch {result['batch_qps']:.1f} queries/s, peak RSS +{result['peak_rss_increase_mb']:.0f} MB")
+
+    reports = {}
+    expanded_queries = None
+    for experiment in experiment_ids:
+        start = time.perf_counter()
+        systems = experiments.experiment_pipelines(experiment, cached=False)
+        load_seconds = time.perf_counter() - start
+        # The thesaurus expansion is query preprocessing, done once and left out of the timings
+        if expanded_queries is None and any(expanded for _, _, expanded in systems):
+            expanded_queries = experiments.thesaurus_query_expansion(queries)
+
+        report = {**metadata, "experiment": experiment, "load_seconds": load_seconds, "pipelines": {}}
+        for name, pipeline, expanded in systems:
+            report["pipelines"][name] = benchmark_pipeline(pipeline, expanded_queries if expanded else queries)
+        print_report(f"Experiment {experiment}", report)
+        save(report, f"experiment_{experiment}")
+        reports[f"experiment_{experiment}"] = report
+
+    if rag is not None:
+        start = time.perf_counter()
+        first_stage = rag.first_stage_retriever(rag.first_stage, rag.candidates, rag.fusion, cached=False)
+        monoT5 = load_monot5(16, rag.monot5_cpu_mode, **rag.monot5_options)
+        pipeline = rag.rerank_pipeline(first_stage, monoT5)
+        load_seconds = time.perf_counter() - start
+
+        report = {**metadata, "first_stage": rag.first_stage, "candidates": rag.candidates, "load_seconds": load_seconds,
+                  "pipelines": {"rag_retriever": benchmark_pipeline(pipeline, queries[["qid", "query"]])}}
+        print_report("RAG retriever", report)
+        save(report, "rag")
+        reports["rag"] = report
+    return reports
+
+# Run in a fresh interpreter by benchmark_startup, prints its timings as json on the last line
+STARTUP_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+timings = {}
+for module in ["collection", "indexes", "experiments", "llm"]:
+    __import__(module)
+    timings["import_" + module] = time.perf_counter() - start
+heavy_modules = [module for module in ["torch", "transformers", "pyterrier_dr", "pyterrier_t5", "openai", "ollama"] if module in sys.modules]
+from collection import BenchmarkCollection
+from indexes import BenchmarkIndex
+collection = BenchmarkCollection()
+indexes = BenchmarkIndex(collection)
+timings["create_objects"] = time.perf_counter() - start
+indexes.load_basic_index()
+timings["load_basic_index"] = time.perf_counter() - start
+indexes.retriever("basic_index", cached=False).search(sys.argv[1])
+timings["first_bm25_query"] = time.perf_counter() - start
+print(json.dumps({"timings": timings, "heavy_modules_after_import": heavy_modules}))
+"""
+
+def benchmark_startup(query="king of spain", repeats=3, results_folder=None) -> dict:
+    # Cold start of the tool: import time of the modules and time to the first BM25 query, each measured
+    # in a new interpreter. Timings are seconds since the start of the script (median of the repeats),
+    # "interpreter_seconds" also includes the python start up. Saved as results/startup/benchmark_<commit>.json
+    import statistics
+    import sys
+    from constants import RESULTS_FOLDER
+
+    runs = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        output = subprocess.run([sys.executable, "-c", STARTUP_SCRIPT, query], capture_output=True, text=True,
+                                cwd=Path(__file__).resolve().parent)
+        wall_seconds = time.perf_counter() - start
+        if output.returncode != 0:
+            raise RuntimeError(f"Startup benchmark failed:\n{output.stderr}")
+        run = json.loads(output.stdout.strip().splitlines()[-1])
+        run["timings"]["interpreter_seconds"] = wall_seconds
+        runs.append(run)
+
+    commit = git_commit()
+    report = {
+        "commit": commit,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "repeats": repeats,
+        "machine": {"platform": platform.platform(), "python": platform.python_version(), "cpus": os.cpu_count()},
+        "timings": {name: statistics.median(run["timings"][name] for run in runs) for name in runs[0]["timings"]},
+        "heavy_modules_after_import": runs[0]["heavy_modules_after_import"],
+    }
+
+    print(f"Startup benchmark ({repeats} runs)")
+    for name, seconds in report["timings"].items():
+        print(f"  {name}: {seconds:.2f}s")
+    print("Heavy modules imported at start up:", ", ".join(report["heavy_modules_after_import"]) or "none")
+
+    save_dir = Path(results_folder or RESULTS_FOLDER) / "startup"
+    save_dir.mkdir(parents=True, exist_ok=True)
+    path = save_dir / f"benchmark_{commit}.json"
+    with open(path, "w") as file:
+        json.dump(report, file, indent=2)
+    print("Benchmark saved to:", path)
+    return report
+
+# Run in a fresh interpreter by benchmark_collection_loading, prints its timings as json on the last line
+COLLECTION_LOADING_SCRIPT = """
+import json, sys, time
+import psutil
+from collection import BenchmarkCollection
+process = psutil.Process()
+collection = BenchmarkCollection(binary_cache=sys.argv[1] == "binary")
+results = {}
+for name in ["documents", "queries", "qrels"]:
+    rss = process.memory_info().rss
+    start = time.perf_counter()
+    getattr(collection, "load_" + name)()
+    results[name + "_seconds"] = time.perf_counter() - start
+    results[name + "_rss_mb"] = (process.memory_info().rss - rss) / 2**20
+print(json.dumps(results))
+"""
+
+def benchmark_collection_loading(repeats=3) -> dict:
+    # load_documents / load_queries / load_qrels from the json files against the binary cache, each run in a new
+    # interpreter so the resident memory of one path does not hide the other. The cache is built before the timed runs
+    import statistics
+    import sys
+
+    def run(mode):
+        output = subprocess.run([sys.executable, "-c", COLLECTION_LOADING_SCRIPT, mode], capture_output=True, text=True,
+                                cwd=Path(__file__).resolve().parent)
+        if output.returncode != 0:
+            raise RuntimeError(f"Collection loading benchmark failed:\n{output.stderr}")
+        return json.loads(output.stdout.strip().splitlines()[-1])
+
+    run("binary")
+    results = {}
+    for mode in ["json", "binary"]:
+        runs = [run(mode) for _ in range(repeats)]
+        results[mode] = {name: statistics.median(result[name] for result in runs) for name in runs[0]}
+
+    print(f"Collection loading benchmark ({repeats} runs)")
+    for name in results["json"]:
+        unit = "s" if name.endswith("seconds") else " MB"
+        print(f"  {name}: json {results['json'][name]:.2f}{unit}, binary {results['binary'][name]:.2f}{unit}")
+    results["documents_speedup"] = results["json"]["documents_seconds"] / results["binary"]["documents_seconds"]
+    print(f"Documents speedup: {results['documents_speedup']:.1f}x")
+    return results
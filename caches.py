@@ -0,0 +1,75 @@
+import hashlib
+import json
+import os
+import pickle
+import sqlite3
+from pathlib import Path
+
+def make_key(*parts) -> str:
+    # Stable key for any combination of json serialisable parts
+    return hashlib.sha1(json.dumps(parts, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+class DiskCache():
+    # Persistent key -> value table stored in sqlite, values are pickled.
+    # The connection is reopened after a fork so process pool workers can share the same file.
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+        self._pid = None
+        self._connection = None
+
+    @property
+    def connection(self):
+        if self._pid != os.getpid():
+            self._connection = sqlite3.connect(str(self.path), timeout=60, check_same_thread=False)
+            self._connection.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB)")
+            self._connection.commit()
+            self._pid = os.getpid()
+        return self._connection
+
+    def get(self, key, default=None):
+        row = self.connection.execute("SELECT value FROM cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return pickle.loads(row[0])
+
+    def get_many(self, keys) -> dict:
+        # Only the keys found in the cache are returned
+        keys = list(dict.fromkeys(keys))
+        found = {}
+        for start in range(0, len(keys), 500):
+            batch = keys[start:start + 500]
+            placeholders = ",".join("?" * len(batch))
+            rows = self.connection.execute(f"SELECT key, value FROM cache WHERE key IN ({placeholders})", batch)
+            for key, value in rows:
+                found[key] = pickle.loads(value)
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    def put(self, key, value):
+        self.put_many({key: value})
+
+    def put_many(self, items: dict):
+        rows = [(key, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)) for key, value in items.items()]
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO cache (key, value) VALUES (?, ?)", rows)
+
+    def __contains__(self, key):
+        return self.connection.execute("SELECT 1 FROM cache WHERE key = ?", (key,)).fetchone() is not None
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
@@ -1,10 +1,16 @@
 from pathlib import Path
 import json
+import os
+import ijson
+import numpy as np
 import pandas as pd
-from constants import RANDOM_STATE
+from constants import RANDOM_STATE, CACHE_FOLDER, COLLECTION_CACHE_FOLDER, COLLECTION_CACHE_BATCH_SIZE
 
 class BenchmarkCollection():
-    def __init__(self, documents_path="document_collection.json", queries_path="test_queries.json", qrels_path="test_qrels.json"):
+    # binary_cache=True converts every json file once to an Arrow file in cache/collection, later loads memory-map it.
+    # binary_cache=False always parses the json files
+    def __init__(self, documents_path="document_collection.json", queries_path="test_queries.json", qrels_path="test_qrels.json",
+                 cache_folder=CACHE_FOLDER, binary_cache=True):
         self.documents_path = Path(documents_path)
         if not self.documents_path.is_file():
             raise FileNotFoundError(f"Documents file does not exist: {self.documents_path}")
@@ -14,27 +20,142 @@ class BenchmarkCollection():
         self.qrels_path = Path(qrels_path)
         if not self.qrels_path.is_file():
             raise FileNotFoundError(f"Qrels file does not exist: {self.qrels_path}")
+        self.cache_folder = Path(cache_folder)
+        self.binary_cache = binary_cache
+
+    def binary_cache_table(self, name: str, source_path: Path, write_table):
+        # Arrow IPC file built by write_table(path) the first time, memory-mapped afterwards.
+        # It is rebuilt when the json file it comes from changes
+        import pyarrow as pa
+        cache_path = self.cache_folder / COLLECTION_CACHE_FOLDER / f"{name}.arrow"
+        manifest_path = cache_path.with_suffix(".json")
+        stat = source_path.stat()
+        source = {"path": str(source_path.resolve()), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+        manifest = None
+        if cache_path.exists() and manifest_path.exists():
+            with manifest_path.open("r", encoding="utf-8") as file:
+                manifest = json.load(file)
+        if manifest != source:
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = cache_path.with_suffix(".tmp")
+            write_table(tmp_path)
+            os.replace(tmp_path, cache_path)
+            with manifest_path.open("w", encoding="utf-8") as file:
+                json.dump(source, file)
+            print(f"{source_path} converted to {cache_path}")
+        return pa.ipc.open_file(pa.memory_map(str(cache_path), "r")).read_all()
+
+    def write_documents_table(self, path):
+        # Streamed into record batches, the json file is never loaded whole. docid is the position in the collection
+        import pyarrow as pa
+        schema = pa.schema([("docid", pa.int32()), ("docno", pa.string()), ("text", pa.string())])
+        def write_batch(writer, docid, batch):
+            columns = [pa.array(range(docid, docid + len(batch)), pa.int32()), pa.array([document["docno"] for document in batch], pa.string()), pa.array([document["text"] for document in batch], pa.string())]
+            writer.write_batch(pa.record_batch(columns, schema=schema))
+
+        with pa.OSFile(str(path), "wb") as sink, pa.ipc.new_file(sink, schema) as writer:
+            docid = 0
+            batch = []
+            for document in self.iter_documents():
+                batch.append(document)
+                if len(batch) == COLLECTION_CACHE_BATCH_SIZE:
+                    write_batch(writer, docid, batch)
+                    docid += len(batch)
+                    batch = []
+            if batch:
+                write_batch(writer, docid, batch)
+
+    def write_dataframe_table(self, dataframe: pd.DataFrame, path, categorical=()):
+        import pyarrow as pa
+        table = pa.Table.from_pandas(dataframe, preserve_index=False)
+        for column in categorical:
+            # Dictionary encoded, comes back as a pandas categorical
+            table = table.set_column(table.schema.get_field_index(column), column, table[column].dictionary_encode())
+        with pa.OSFile(str(path), "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
 
     def load_documents(self):
+        # Both paths give docid (int32, position in the collection) and docno, text as Arrow strings
+        import pyarrow as pa
+        if self.binary_cache:
+            table = self.binary_cache_table("documents", self.documents_path, self.write_documents_table)
+            # docno and text stay backed by the memory-mapped file, they are not copied into Python objects
+            self.corpus_dataframe = table.to_pandas(types_mapper=lambda arrow_type: pd.ArrowDtype(arrow_type) if pa.types.is_string(arrow_type) else None)
+            print("Documents loaded successfully.")
+            return
         with self.documents_path.open("r", encoding="utf-8") as file:
             data = json.load(file)
-        df = pd.DataFrame.from_dict(data)
-        self.corpus_dataframe = df.rename(columns={"para_id": "docno", "context": "text"})[["docno", "text"]]
+        df = pd.DataFrame.from_dict(data).rename(columns={"para_id": "docno", "context": "text"})
+        self.corpus_dataframe = pd.DataFrame({
+            "docid": np.arange(len(df), dtype=np.int32),
+            "docno": df["docno"].astype(pd.ArrowDtype(pa.string())),
+            "text": df["text"].astype(pd.ArrowDtype(pa.string())),
+        })
         print("Documents loaded successfully.")
 
-    def load_queries(self):
+    def iter_documents(self):
+        # Parse the documents file incrementally, one {docno, text} dict at a time
+        with self.documents_path.open("rb") as file:
+            for record in ijson.items(file, "item"):
+                yield {"docno": record["para_id"], "text": record["context"]}
+
+    def document_statistics(self):
+        # Streaming pass over the documents, used to size the index meta fields without loading the corpus
+        if not hasattr(self, "documents_statistics"):
+            statistics = {"documents": 0, "longest_docno": 0, "longest_text": 0}
+            for document in self.iter_documents():
+                statistics["documents"] += 1
+                statistics["longest_docno"] = max(statistics["longest_docno"], len(document["docno"]))
+                statistics["longest_text"] = max(statistics["longest_text"], len(document["text"]))
+            self.documents_statistics = statistics
+        return self.documents_statistics
+
+    def read_queries_json(self) -> pd.DataFrame:
         with self.queries_path.open('r', encoding='utf-8') as file:
             data = json.load(file)
-        self.queries = pd.DataFrame.from_dict(data)
-        self.queries.rename(columns={"query_id": "qid", "question": "query"}, inplace=True)
+        queries = pd.DataFrame.from_dict(data)
+        return queries.rename(columns={"query_id": "qid", "question": "query"})
+
+    def read_qrels_json(self) -> pd.DataFrame:
+        with self.qrels_path.open('r', encoding='utf-8') as file:
+            data = json.load(file)
+        qrels = pd.DataFrame.from_dict(data)
+        return qrels.rename(columns={"query_id": "qid", "para_id": "docno"})
+
+    def load_queries(self):
+        if self.binary_cache:
+            table = self.binary_cache_table("queries", self.queries_path, lambda path: self.write_dataframe_table(self.read_queries_json(), path))
+            self.queries = table.to_pandas()
+        else:
+            self.queries = self.read_queries_json()
         print("Queries loaded successfully.")
         
     def load_qrels(self):
-        with self.qrels_path.open('r', encoding='utf-8') as file:
-            data = json.load(file)
-        self.qrels = pd.DataFrame.from_dict(data)
-        self.qrels.rename(columns={"query_id": "qid", "para_id": "docno"}, inplace=True)
+        if self.binary_cache:
+            # Stored sorted by qid, with categorical docnos and the smallest integer type for the labels
+            def write_qrels(path):
+                qrels = self.read_qrels_json().sort_values("qid", kind="stable").reset_index(drop=True)
+                for column in qrels.select_dtypes("integer").columns:
+                    qrels[column] = pd.to_numeric(qrels[column], downcast="integer")
+                self.write_dataframe_table(qrels, path, categorical=["docno"])
+            self.qrels = self.binary_cache_table("qrels", self.qrels_path, write_qrels).to_pandas()
+        else:
+            self.qrels = self.read_qrels_json()
+        self.group_qrels()
         print("Qrels loaded successfully.")
+
+    def group_qrels(self):
+        # Rows of every qid, so the judgments of a set of queries are sliced out instead of filtering all the qrels
+        order = np.argsort(self.qrels["qid"].to_numpy(), kind="stable")
+        qids, starts, counts = np.unique(self.qrels["qid"].to_numpy()[order], return_index=True, return_counts=True)
+        self.qrels_order = order
+        self.qrels_groups = {qid: (start, start + count) for qid, start, count in zip(qids, starts, counts)}
+
+    def qrels_for(self, qids) -> pd.DataFrame:
+        if not hasattr(self, "qrels"):
+            raise RuntimeError("Qrels not loaded. Call load_qrels() first.")
+        rows = [self.qrels_order[start:end] for start, end in (self.qrels_groups[qid] for qid in dict.fromkeys(qids) if qid in self.qrels_groups)]
+        return self.qrels.iloc[np.concatenate(rows) if rows else []]
     
     def sample_queries(self, n=1000, random_state=RANDOM_STATE):
         if not hasattr(self, "queries"):
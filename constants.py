@@ -1,4 +1,4 @@
-from pyterrier.measures import P, R, nDCG, MAP
+from ir_measures import P, R, nDCG, MAP  # same measures as pyterrier.measures, without importing pyterrier
 
 EVAL_METRICS = [P@1, P@5, P@10, R@5, R@10, nDCG@5, nDCG@10, MAP]
 
@@ -7,6 +7,34 @@ BASIC_INDEX_NAME = "basic_index"
 KEYWORDS_INDEX_NAME = "keywords_expanded_index"
 TWO_FIELDS_INDEX_NAME = "two_fields_index"
 DENSE_INDEX_NAME = "dense_index.flex"
+DENSE_CHECKPOINTS_FOLDER = "dense_index_checkpoints"
+DENSE_CHECKPOINT_SIZE = 10000
+EXPANSION_FOLDER = "expanded_documents"
+EXPANSION_CHUNK_SIZE = 1000
+DELTA_SEGMENTS_FOLDER = "delta_segments"
+DOCUMENT_STORE_NAME = "document_store"
+DOCUMENT_STORE_BLOCK_SIZE = 64
+INDEXING_THREADS = 1
 RESULTS_FOLDER = "results"
+CACHE_FOLDER = "cache"
+COLLECTION_CACHE_FOLDER = "collection"
+COLLECTION_CACHE_BATCH_SIZE = 65536
+SYNONYM_TABLE_NAME = "synonym_table.sqlite"
+RUN_CACHE_NAME = "run_cache.sqlite"
+QUERY_RUNS_CACHE_NAME = "query_runs.sqlite"
+QUERY_EXPANSION_CACHE_NAME = "query_expansions.sqlite"
+QUERY_EXPANSION_BATCH_SIZE = 200
+MONOT5_CACHE_NAME = "monot5_scores.sqlite"
+MONOT5_MODEL = "castorini/monot5-base-msmarco"
+QUERY_EMBEDDING_CACHE_NAME = "query_embeddings.sqlite"
+DENSE_MODEL_NAME = "Shitao/RetroMAE_MSMARCO_distill"
+RRF_K = 60
+HYBRID_BRANCH_DEPTH = 100
+
+LMSTUDIO_BASE_URL = "http://localhost:1234/v1"
+OLLAMA_CLOUD_HOST = "https://ollama.com"
+LLM_MAX_CONNECTIONS = 16
+LLM_TIMEOUT = 120
+LLM_CONCURRENCY = 8
 
 RANDOM_STATE = 42
\ No newline at end of file
@@ -0,0 +1,234 @@
+import json
+import math
+import os
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import pyterrier as pt
+from pyterrier_dr import FlexIndex
+
+COMPACT_FILES = {
+    "float16": ["vecs.f2.npy"],
+    "int8": ["vecs.i8.npy", "scales.f4.npy"],
+}
+# FAISS scalar quantizer that keeps the ANN storage at the precision of the compact vectors
+FAISS_QUANTIZERS = {
+    "float16": "QT_fp16",
+    "int8": "QT_8bit",
+}
+
+class CompactVectors():
+    # Read-only view over reduced precision vectors that gives back float32 rows,
+    # so FlexIndex retrievers and scorers can use it in place of the vecs.f4 memmap
+    def __init__(self, vecs: np.ndarray, scales: np.ndarray | None = None):
+        self.vecs = vecs
+        self.scales = scales
+        self.shape = vecs.shape
+        self.dtype = np.dtype(np.float32)
+        self.ndim = vecs.ndim
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        vecs = np.asarray(self.vecs[key], dtype=np.float32)
+        if self.scales is None:
+            return vecs
+        return vecs * np.expand_dims(np.asarray(self.scales[key], dtype=np.float32), -1)
+
+    def __array__(self, dtype=None, copy=None):
+        return self[:].astype(dtype or np.float32, copy=False)
+
+def write_compact_vectors(index_path, precision: str, batch_size=65536):
+    # Convert vecs.f4 of a FlexIndex to float16, or to int8 with one scale factor per vector
+    if precision not in COMPACT_FILES:
+        raise ValueError(f"precision must be one of {list(COMPACT_FILES)}")
+    index_path = Path(index_path)
+    with open(index_path / "pt_meta.json", "rt") as file:
+        meta = json.load(file)
+    shape = (meta["doc_count"], meta["vec_size"])
+    dvecs = np.memmap(index_path / "vecs.f4", mode="r", dtype=np.float32, shape=shape)
+
+    # Written under temporary names first, an interrupted conversion never leaves a broken store
+    dtype = np.float16 if precision == "float16" else np.int8
+    tmp_vecs = index_path / f"{COMPACT_FILES[precision][0]}.tmp"
+    vecs = np.lib.format.open_memmap(tmp_vecs, mode="w+", dtype=dtype, shape=shape)
+    if precision == "int8":
+        tmp_scales = index_path / f"{COMPACT_FILES[precision][1]}.tmp"
+        scales = np.lib.format.open_memmap(tmp_scales, mode="w+", dtype=np.float32, shape=(shape[0],))
+
+    for start in range(0, shape[0], batch_size):
+        batch = np.asarray(dvecs[start:start + batch_size])
+        if precision == "float16":
+            vecs[start:start + batch_size] = batch.astype(np.float16)
+        else:
+            batch_scales = np.abs(batch).max(axis=1) / 127
+            batch_scales[batch_scales == 0] = 1
+            vecs[start:start + batch_size] = np.round(batch / batch_scales[:, None]).astype(np.int8)
+            scales[start:start + batch_size] = batch_scales
+
+    vecs.flush()
+    del vecs
+    os.replace(tmp_vecs, index_path / COMPACT_FILES[precision][0])
+    if precision == "int8":
+        scales.flush()
+        del scales
+        os.replace(tmp_scales, index_path / COMPACT_FILES[precision][1])
+
+def load_compact_vectors(index_path, precision: str) -> CompactVectors:
+    index_path = Path(index_path)
+    files = [index_path / name for name in COMPACT_FILES[precision]]
+    missing = [str(file) for file in files if not file.exists()]
+    if missing:
+        raise RuntimeError(f"Compact {precision} vectors do not exist: {missing}")
+    vecs = np.load(files[0], mmap_mode="r")
+    scales = np.load(files[1], mmap_mode="r") if precision == "int8" else None
+    return CompactVectors(vecs, scales)
+
+class CompactFlexIndex(FlexIndex):
+    # FlexIndex that memory-maps the reduced precision vectors instead of vecs.f4
+    def __init__(self, path: str, precision: str, **kwargs):
+        if precision not in COMPACT_FILES:
+            raise ValueError(f"precision must be one of {list(COMPACT_FILES)}")
+        super().__init__(path, **kwargs)
+        self.precision = precision
+
+    def payload(self, return_dvecs=True, return_docnos=True):
+        if return_dvecs and self._dvecs is None:
+            self._dvecs = load_compact_vectors(self.index_path, self.precision)
+        return super().payload(return_dvecs=return_dvecs, return_docnos=return_docnos)
+
+    def faiss_quantizer(self):
+        import faiss
+        return getattr(faiss.ScalarQuantizer, FAISS_QUANTIZERS[self.precision])
+
+    def add_vectors(self, faiss_index, dvecs, batch_size=4096):
+        for start in range(0, dvecs.shape[0], batch_size):
+            faiss_index.add(np.asarray(dvecs[start:start + batch_size], dtype=np.float32))
+
+    def sample_vectors(self, dvecs, count) -> np.ndarray:
+        # Same seed as pyterrier_dr, rows read in file order from the memory map
+        count = min(count, dvecs.shape[0])
+        rows = np.sort(np.random.RandomState(0).choice(dvecs.shape[0], size=count, replace=False))
+        return np.asarray(dvecs[rows], dtype=np.float32)
+
+    # pyterrier_dr builds the FAISS structures from vecs.f4 (the HNSW storage is read straight from the file)
+    # and caches them under names without the precision. Here they are built from the compact vectors, with
+    # scalar quantized storage of the same precision, and cached apart from the float32 ones.
+    def faiss_hnsw_retriever(self, neighbours=32, *, num_results=1000, ef_construction=40, ef_search=16, cache=True, search_bounded_queue=True, qbatch=64, drop_query_vec=False):
+        import faiss
+        from pyterrier_dr.flex.faiss_retr import FaissRetriever
+        key = ("faiss_hnsw", neighbours, ef_construction, self.precision)
+        if key not in self._cache:
+            path = self.index_path / f"hnsw_n-{neighbours}_ef-{ef_construction}_{self.precision}.faiss"
+            if path.exists():
+                self._cache[key] = faiss.read_index(str(path))
+            else:
+                dvecs, _ = self.payload(return_docnos=False)
+                index = faiss.IndexHNSWSQ(dvecs.shape[1], self.faiss_quantizer(), neighbours, faiss.METRIC_INNER_PRODUCT)
+                index.hnsw.efConstruction = ef_construction
+                index.train(self.sample_vectors(dvecs, 100_000))
+                self.add_vectors(index, dvecs)
+                if cache:
+                    faiss.write_index(index, str(path))
+                self._cache[key] = index
+        return FaissRetriever(self, self._cache[key], num_results=num_results, ef_search=ef_search, search_bounded_queue=search_bounded_queue, qbatch=qbatch, drop_query_vec=drop_query_vec, index_spec=key)
+
+    def faiss_ivf_retriever(self, *, num_results=1000, train_sample=None, n_list=None, cache=True, n_probe=1, drop_query_vec=False):
+        import faiss
+        from pyterrier_dr.flex.faiss_retr import FaissRetriever
+        dvecs, _ = self.payload(return_docnos=False)
+        # Defaults of pyterrier_dr: about sqrt(documents) lists rounded to a power of 2, 39 training vectors per list
+        if n_list is None:
+            n_list = max(int(1 << math.ceil(math.log2(math.ceil(math.sqrt(dvecs.shape[0]))))), 4) if train_sample is None else max(math.floor(train_sample / 39), 4)
+        if train_sample is None:
+            train_sample = n_list * 39
+        elif 0 < train_sample < 1:
+            train_sample = math.ceil(train_sample * dvecs.shape[0])
+        key = ("faiss_ivf", n_list, train_sample, self.precision)
+        if key not in self._cache:
+            path = self.index_path / f"ivf_nlist-{n_list}_train-{train_sample}_{self.precision}.faiss"
+            if path.exists():
+                self._cache[key] = faiss.read_index(str(path))
+            else:
+                index = faiss.IndexIVFScalarQuantizer(faiss.IndexFlatIP(dvecs.shape[1]), dvecs.shape[1], n_list, self.faiss_quantizer(), faiss.METRIC_INNER_PRODUCT)
+                index.train(self.sample_vectors(dvecs, train_sample))
+                self.add_vectors(index, dvecs)
+                if cache:
+                    faiss.write_index(index, str(path))
+                self._cache[key] = index
+        return FaissRetriever(self, self._cache[key], num_results=num_results, n_probe=n_probe, drop_query_vec=drop_query_vec, index_spec=key)
+
+    def __repr__(self):
+        return f"CompactFlexIndex({str(self.index_path)!r}, {self.precision!r})"
+
+class SegmentedFlexIndex():
+    # A base FlexIndex and its delta segments (small FlexIndexes of documents added later) searched as one index.
+    # Approximate retrievers run on the base only, the deltas are always scanned exhaustively.
+    def __init__(self, base: FlexIndex, deltas: list):
+        self.base = base
+        self.deltas = deltas    # [(FlexIndex, docnos)]
+        self.precision = getattr(base, "precision", None)
+
+    def __len__(self):
+        return len(self.base) + sum(len(docnos) for _, docnos in self.deltas)
+
+    def __repr__(self):
+        return f"SegmentedFlexIndex({self.base!r}, {len(self.deltas)} delta(s))"
+
+    def segment_retriever(self, base_retriever: pt.Transformer, num_results: int) -> pt.Transformer:
+        retrievers = [base_retriever] + [delta.retriever(num_results=num_results) for delta, _ in self.deltas]
+        return SegmentedRetriever(retrievers, num_results)
+
+    def retriever(self, num_results=1000, **kwargs):
+        return self.segment_retriever(self.base.retriever(num_results=num_results, **kwargs), num_results)
+
+    def faiss_ivf_retriever(self, num_results=1000, **kwargs):
+        return self.segment_retriever(self.base.faiss_ivf_retriever(num_results=num_results, **kwargs), num_results)
+
+    def faiss_hnsw_retriever(self, neighbours=32, num_results=1000, **kwargs):
+        return self.segment_retriever(self.base.faiss_hnsw_retriever(neighbours, num_results=num_results, **kwargs), num_results)
+
+    def scorer(self):
+        segments = [(set(docnos), delta.scorer()) for delta, docnos in self.deltas]
+        return SegmentedScorer(self.base.scorer(), segments)
+
+class SegmentedRetriever(pt.Transformer):
+    # Top num_results over the runs of every segment. Docids are per segment, only docnos are kept
+    def __init__(self, retrievers: list, num_results=1000):
+        self.retrievers = retrievers
+        self.num_results = num_results
+
+    def transform(self, topics: pd.DataFrame) -> pd.DataFrame:
+        results = pd.concat([retriever.transform(topics) for retriever in self.retrievers], ignore_index=True)
+        results = pt.model.add_ranks(results.drop(columns=["docid"], errors="ignore"))
+        return results[results["rank"] < self.num_results].sort_values(["qid", "rank"]).reset_index(drop=True)
+
+class DocnoScorer(pt.Transformer):
+    # FlexIndex scorers look the vectors up by the docid column when the results have one, but those are
+    # Terrier docids, which do not follow the dense index order (threads>1 builds shuffle them). Score by docno
+    def __init__(self, scorer: pt.Transformer):
+        self.scorer = scorer
+
+    def transform(self, results: pd.DataFrame) -> pd.DataFrame:
+        return self.scorer.transform(results.drop(columns=["docid"], errors="ignore"))
+
+class SegmentedScorer(pt.Transformer):
+    # Every candidate is scored by the segment that holds its docno, the base holds all the others
+    def __init__(self, base_scorer: pt.Transformer, segments: list):
+        self.base_scorer = base_scorer
+        self.segments = segments    # [(docnos set, scorer)]
+
+    def transform(self, results: pd.DataFrame) -> pd.DataFrame:
+        results = results.drop(columns=["docid"], errors="ignore")
+        remaining = np.ones(len(results), dtype=bool)
+        scored = []
+        for docnos, scorer in self.segments:
+            in_segment = results["docno"].isin(docnos).to_numpy()
+            if in_segment.any():
+                scored.append(scorer.transform(results[in_segment]))
+            remaining &= ~in_segment
+        if remaining.any() or not scored:
+            scored.append(self.base_scorer.transform(results[remaining]))
+        scored = pd.concat(scored, ignore_index=True).drop(columns=["docid"], errors="ignore")
+        return pt.model.add_ranks(scored)
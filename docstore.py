@@ -0,0 +1,192 @@
+import json
+import os
+import zlib
+from collections import OrderedDict
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import pyterrier as pt
+
+STORE_ARRAYS = ["block_offsets", "block_docs", "text_offsets", "docnos", "sorted_docnos", "sorted_docids"]
+
+class DocumentStore():
+    # Document texts compressed in blocks of block_size documents, looked up by docno or by position.
+    # A position is the order in which the document was stored, not a Terrier docid: look BM25 results up by docno.
+    # blocks.bin is memory-mapped, only the blocks holding the requested documents are decompressed.
+    #   block_offsets[b:b+2]  start and end of block b in blocks.bin
+    #   block_docs[b]         position of the first document of block b
+    #   text_offsets[d:d+2]   start and end of the document at position d in the decompressed text of the store
+    #   sorted_docnos         docnos in sorted order (utf-8) with their sorted_docids (positions), for binary search
+    # The arrays of every append are a new generation of files, meta.json names the current one
+    def __init__(self, path, cached_blocks=64):
+        self.path = Path(path)
+        if not (self.path / "meta.json").exists():
+            raise RuntimeError(f"Document store does not exist: {self.path}")
+        self.cached_blocks = cached_blocks
+        self.load()
+
+    def load(self):
+        with open(self.path / "meta.json", "r", encoding="utf-8") as file:
+            self.meta = json.load(file)
+        for name in STORE_ARRAYS:
+            setattr(self, name, np.load(array_path(self.path, name, self.meta.get("generation")), mmap_mode="r"))
+        size = int(self.block_offsets[-1])
+        self.blocks = np.memmap(self.path / "blocks.bin", dtype=np.uint8, mode="r", shape=(size,)) if size else np.zeros(0, dtype=np.uint8)
+        self.block_cache = OrderedDict()
+
+    def close(self):
+        # Drop the memory maps, the files can only be replaced on Windows once nothing maps them
+        for name in ["blocks"] + STORE_ARRAYS:
+            if hasattr(self, name):
+                delattr(self, name)
+        self.block_cache = OrderedDict()
+
+    def __len__(self):
+        return self.meta["documents"]
+
+    def __repr__(self):
+        return f"DocumentStore({str(self.path)!r}, {len(self)} documents)"
+
+    def positions(self, docnos) -> np.ndarray:
+        # Store position of every docno, -1 for the ones that are not in the store
+        keys = np.array([str(docno).encode("utf-8") for docno in docnos])
+        if not len(self) or not len(keys):
+            return np.full(len(keys), -1, dtype=np.int64)
+        sorted_at = np.minimum(np.searchsorted(self.sorted_docnos, keys), len(self) - 1)
+        found = self.sorted_docnos[sorted_at] == keys
+        return np.where(found, self.sorted_docids[sorted_at], -1).astype(np.int64)
+
+    def block(self, block_id: int) -> bytes:
+        # Decompressed block, the most recently used ones are kept
+        if block_id in self.block_cache:
+            self.block_cache.move_to_end(block_id)
+            return self.block_cache[block_id]
+        start, end = int(self.block_offsets[block_id]), int(self.block_offsets[block_id + 1])
+        block = zlib.decompress(self.blocks[start:end].tobytes())
+        self.block_cache[block_id] = block
+        if len(self.block_cache) > self.cached_blocks:
+            self.block_cache.popitem(last=False)
+        return block
+
+    def get_by_positions(self, positions) -> list[str]:
+        # Texts by store position (see positions()), not by Terrier docid
+        positions = np.asarray(positions, dtype=np.int64)
+        if ((positions < 0) | (positions >= len(self))).any():
+            raise KeyError(f"Positions not in the document store: {positions[(positions < 0) | (positions >= len(self))][:10].tolist()}")
+        texts = [None] * len(positions)
+        block_ids = np.searchsorted(self.block_docs, positions, side="right") - 1
+        # Documents of the same block are read together, so each block is decompressed once
+        for i in np.argsort(block_ids, kind="stable"):
+            block_id, position = int(block_ids[i]), int(positions[i])
+            block_start = int(self.text_offsets[self.block_docs[block_id]])
+            start, end = int(self.text_offsets[position]) - block_start, int(self.text_offsets[position + 1]) - block_start
+            texts[i] = self.block(block_id)[start:end].decode("utf-8")
+        return texts
+
+    def get(self, docnos) -> list[str]:
+        docnos = list(docnos)
+        positions = self.positions(docnos)
+        if (positions < 0).any():
+            missing = [docno for docno, position in zip(docnos, positions) if position < 0]
+            raise KeyError(f"{len(missing)} docnos not in the document store, e.g. {missing[:10]}")
+        return self.get_by_positions(positions)
+
+    def append(self, documents, block_size=None):
+        # Add {docno, text} documents that are not in the store yet, as new blocks at the end of blocks.bin.
+        # Bytes past the end recorded in block_offsets are ignored and the arrays go to a new generation of files,
+        # meta.json is only replaced at the end: an append interrupted at any point leaves the store as it was
+        documents = list(documents)
+        new_documents = [document for document, position in zip(documents, self.positions([document["docno"] for document in documents])) if position < 0]
+        if not new_documents:
+            return 0
+        state = {
+            "block_offsets": list(np.asarray(self.block_offsets)),
+            "block_docs": list(np.asarray(self.block_docs)),
+            "text_offsets": list(np.asarray(self.text_offsets)),
+            "docnos": [docno.decode("utf-8") for docno in np.asarray(self.docnos)],
+        }
+        block_size = block_size or self.meta["block_size"]
+        blocks_end = int(self.block_offsets[-1])
+        generation = self.meta.get("generation")
+        self.close()
+        with open(self.path / "blocks.bin", "r+b") as file:
+            # Drop the bytes of an append that was interrupted before its meta.json
+            file.truncate(blocks_end)
+            file.seek(blocks_end)
+            write_blocks(file, new_documents, block_size, self.meta["level"], state)
+        save_store_arrays(self.path, state, block_size, self.meta["level"], (generation or 0) + 1)
+        # The previous generation is only needed by readers that still map it
+        for name in STORE_ARRAYS:
+            try:
+                os.remove(array_path(self.path, name, generation))
+            except OSError:
+                pass
+        self.load()
+        return len(new_documents)
+
+def write_blocks(file, documents, block_size, level, state):
+    # Compress the documents block by block into file, extending the arrays in state
+    block = []
+    for document in documents:
+        block.append(document["text"].encode("utf-8"))
+        state["docnos"].append(document["docno"])
+        state["text_offsets"].append(state["text_offsets"][-1] + len(block[-1]))
+        if len(block) == block_size:
+            state["block_docs"].append(len(state["docnos"]) - len(block))
+            state["block_offsets"].append(state["block_offsets"][-1] + file.write(zlib.compress(b"".join(block), level)))
+            block = []
+    if block:
+        state["block_docs"].append(len(state["docnos"]) - len(block))
+        state["block_offsets"].append(state["block_offsets"][-1] + file.write(zlib.compress(b"".join(block), level)))
+
+def array_path(path, name: str, generation=None) -> Path:
+    # Stores written before generations were added have a single set of arrays without a number
+    return Path(path) / (f"{name}.npy" if generation is None else f"{name}.{generation}.npy")
+
+def save_store_arrays(path, state, block_size, level, generation=0):
+    # The arrays are written under the names of generation, meta.json (replaced last) makes them the current ones
+    path = Path(path)
+    docnos = np.array([docno.encode("utf-8") for docno in state["docnos"]]) if state["docnos"] else np.zeros(0, dtype="S1")
+    order = np.argsort(docnos, kind="stable")
+    arrays = {
+        "block_offsets": np.asarray(state["block_offsets"], dtype=np.int64),
+        "block_docs": np.asarray(state["block_docs"], dtype=np.int64),
+        "text_offsets": np.asarray(state["text_offsets"], dtype=np.int64),
+        "docnos": docnos,
+        "sorted_docnos": docnos[order],
+        "sorted_docids": order.astype(np.int64),
+    }
+    for name, array in arrays.items():
+        with open(array_path(path, name, generation), "wb") as file:
+            np.save(file, array)
+    with open(path / "meta.json.tmp", "w", encoding="utf-8") as file:
+        json.dump({"documents": len(state["docnos"]), "block_size": block_size, "compression": "zlib", "level": level, "generation": generation}, file)
+    os.replace(path / "meta.json.tmp", path / "meta.json")
+
+def write_document_store(path, documents, block_size=64, level=6) -> DocumentStore:
+    # Build a store from {docno, text} documents, streamed one block at a time
+    path = Path(path)
+    if path.exists():
+        raise RuntimeError(f"Document store already exists: {path}")
+    tmp_path = path.with_name(f"{path.name}.tmp")
+    if tmp_path.exists():
+        for name in os.listdir(tmp_path):
+            os.remove(tmp_path / name)
+    tmp_path.mkdir(parents=True, exist_ok=True)
+    state = {"block_offsets": [0], "block_docs": [], "text_offsets": [0], "docnos": []}
+    with open(tmp_path / "blocks.bin", "wb") as file:
+        write_blocks(file, documents, block_size, level, state)
+    save_store_arrays(tmp_path, state, block_size, level)
+    os.replace(tmp_path, path)
+    return DocumentStore(path)
+
+class DocumentText(pt.Transformer):
+    # pt.text.get_text for the document store: adds the text of every docno to the results
+    def __init__(self, store: DocumentStore, text_field="text"):
+        self.store = store
+        self.text_field = text_field
+
+    def transform(self, results: pd.DataFrame) -> pd.DataFrame:
+        results = results.copy()
+        results[self.text_field] = self.store.get(results["docno"]) if len(results) else pd.Series(dtype=object)
+        return results
@@ -1,19 +1,55 @@
+import json
+import multiprocessing
+import os
+import re
+import numpy as np
 import pandas as pd
 import pyterrier as pt
-from constants import EVAL_METRICS, RESULTS_FOLDER
-from functions import keywords_extractor, thesaurus_based_expansion
+from constants import EVAL_METRICS, RESULTS_FOLDER, CACHE_FOLDER, SYNONYM_TABLE_NAME, QUERY_EXPANSION_CACHE_NAME, QUERY_EXPANSION_BATCH_SIZE, MONOT5_CACHE_NAME, QUERY_RUNS_CACHE_NAME
+from functions import expand_texts, get_synonym_cache
+from caches import DiskCache, make_key
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from tqdm import tqdm
 from collection import BenchmarkCollection
 from indexes import BenchmarkIndex
 from pathlib import Path
-from pyterrier_dr import RetroMAE
-from pyterrier_t5 import MonoT5ReRanker
+from pipelines import cached_monot5, load_monot5, ScoreRatioFilter, FirstPassages, PipelineProfile, instrument
+
+# Indexes whose contents the runs of each experiment depend on
+EXPERIMENT_INDEXES = {
+    1: ["basic_index"],
+    2: ["basic_index"],
+    3: ["keywords_expanded_index"],
+    4: ["two_fields_index"],
+    5: ["basic_index", "dense_index"],
+    6: ["basic_index"],
+}
+
+def write_run(run: pd.DataFrame, save_file: Path):
+    # Written under a temporary name first, an interrupted write is never reused as a finished run
+    tmp_file = save_file.with_name(save_file.name.replace(".res.gz", ".partial.res.gz"))
+    pt.io.write_results(run, str(tmp_file))
+    os.replace(tmp_file, save_file)
+
+def run_keys_path(save_file: Path) -> Path:
+    # Query run store keys of the queries in a run file, written next to it by materialise_runs
+    return save_file.with_name(save_file.name.replace(".res.gz", ".keys.json"))
 
 class BenchmarkExperiments():
-    def __init__(self, collection: BenchmarkCollection, indexes: BenchmarkIndex, results_folder=RESULTS_FOLDER):
+    def __init__(self, collection: BenchmarkCollection, indexes: BenchmarkIndex, results_folder=RESULTS_FOLDER, cache_folder=CACHE_FOLDER, profile=False,
+                 workers=1, query_shards=None, incremental=True):
         self.collection = collection
         self.indexes = indexes
+        # workers > 1 computes the runs of experiments 1-6 on a process pool, one task per system and query shard
+        # (query_shards, default one per worker). Each worker opens the loaded indexes from indexes_folder itself.
+        self.workers = workers
+        self.query_shards = query_shards
+        # incremental=True keeps the runs of experiments 1-6 per system and query, growing a sample only retrieves the new queries
+        self.incremental = incremental
+        # profile=True times every stage of the systems run by the experiments, see self.profile.report()
+        self.profile = PipelineProfile() if profile else None
         self.results_folder = Path(results_folder).resolve()
+        self.cache_folder = Path(cache_folder).resolve()
 
         if not (hasattr(self.collection, "queries") and hasattr(self.collection, "qrels")):
             raise RuntimeError("Queries and Qrels must be loaded before running experiments.")
@@ -22,28 +58,218 @@ class BenchmarkExperiments():
 
     def create_results_folder(self):
         self.results_folder.mkdir(parents=True, exist_ok=True)
+
+    def instrumented(self, pipelines: list, names: list[str]) -> list:
+        return [instrument(pipeline, self.profile, name) for pipeline, name in zip(pipelines, names)]
         
-    def thesaurus_query_expansion(self, queries: pd.DataFrame) -> pd.DataFrame:
+    def thesaurus_query_expansion(self, queries: pd.DataFrame, use_synonym_table=True, max_keywords=3, method="rake", max_synonyms_per_keyword=2,
+                                  batch_size=QUERY_EXPANSION_BATCH_SIZE, workers=None) -> pd.DataFrame:
         expanded_queries = queries.copy()
 
         expanded_queries["query_0"] = expanded_queries["query"]
 
-        tqdm.pandas(desc="Expanding queries with thesaurus")
-        expanded_queries["query"] = expanded_queries["query"].progress_apply(
-            lambda q: q + " " + " ".join(
-                thesaurus_based_expansion(q, keywords_extractor(q))
-            )
-        )
+        # Expanded queries are kept on disk, keyed by qid, query text and expansion parameters
+        if not hasattr(self, "expansion_cache"):
+            self.expansion_cache = DiskCache(self.cache_folder / QUERY_EXPANSION_CACHE_NAME)
+        parameters = {"max_keywords": max_keywords, "method": method, "max_synonyms_per_keyword": max_synonyms_per_keyword}
+        keys = [make_key(qid, query, parameters) for qid, query in zip(expanded_queries["qid"], expanded_queries["query"])]
+        expansions = self.expansion_cache.get_many(keys)
+
+        missing = {key: query for key, query in zip(keys, expanded_queries["query"]) if key not in expansions}
+        print(f"Query expansion: {len(keys) - len(missing)}/{len(keys)} queries already expanded.")
+
+        if missing:
+            # The synonym table keeps WordNet lookups on disk between runs
+            synonym_table = self.cache_folder / SYNONYM_TABLE_NAME if use_synonym_table else None
+            missing_keys = list(missing)
+            texts = list(missing.values())
+            batches = [(missing_keys[start:start + batch_size], texts[start:start + batch_size]) for start in range(0, len(texts), batch_size)]
+
+            if len(batches) == 1:
+                # Not worth starting a process pool for a single batch
+                new_expansions = dict(zip(missing_keys, expand_texts(texts, max_keywords, method, max_synonyms_per_keyword, synonym_table)))
+                print("Synonym cache:", get_synonym_cache(synonym_table).stats())
+            else:
+                new_expansions = {}
+                # Spawned like process_pool(), the indexes are loaded by now and the JVM cannot be forked
+                with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+                    futures = {
+                        executor.submit(expand_texts, batch_texts, max_keywords, method, max_synonyms_per_keyword, synonym_table): batch_keys
+                        for batch_keys, batch_texts in batches
+                    }
+                    for future in tqdm(as_completed(futures), total=len(futures), desc="Expanding queries with thesaurus"):
+                        new_expansions.update(zip(futures[future], future.result()))
+
+            self.expansion_cache.put_many(new_expansions)
+            expansions.update(new_expansions)
+
+        expanded_queries["query"] = [query + " " + expansions[key] for key, query in zip(keys, expanded_queries["query"])]
         return expanded_queries
 
+    def process_pool(self):
+        # Started once and reused by every experiment. Workers are spawned, not forked, the JVM of this process cannot be forked
+        if not hasattr(self, "executor"):
+            index_names = [name for name in ["basic_index", "keywords_expanded_index", "two_fields_index", "dense_index"] if hasattr(self.indexes, name)]
+            dense_precision = getattr(getattr(self.indexes, "dense_index", None), "precision", None)
+            collection_paths = tuple(str(path.resolve()) for path in [self.collection.documents_path, self.collection.queries_path, self.collection.qrels_path])
+            collection_paths += (str(self.collection.cache_folder.resolve()), self.collection.binary_cache)
+            folders = (str(self.indexes.indexes_folder), str(self.results_folder), str(self.cache_folder))
+            self.executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=init_experiment_worker,
+                initargs=(collection_paths, folders, index_names, dense_precision),
+            )
+        return self.executor
+
+    def close_workers(self):
+        if hasattr(self, "executor"):
+            self.executor.shutdown()
+            del self.executor
+
+    def parallel_transform(self, experiment: int, jobs: dict, options: dict) -> dict:
+        # {name: (position, topics)} -> {name: run}, one pool task per system and query shard, shards merged back in query order
+        executor = self.process_pool()
+        futures = {}
+        runs = {}
+        for name, (position, topics) in jobs.items():
+            shards = [shard for shard in np.array_split(np.arange(len(topics)), self.query_shards or self.workers) if len(shard)]
+            runs[name] = [None] * len(shards)
+            for i, shard in enumerate(shards):
+                futures[executor.submit(run_experiment_shard, experiment, position, topics.iloc[shard], options)] = (name, i)
+        for future in tqdm(as_completed(futures), total=len(futures), desc=f"Experiment {experiment} shards"):
+            name, i = futures[future]
+            runs[name][i] = future.result()
+        return {name: pd.concat(shard_runs, ignore_index=True) for name, shard_runs in runs.items()}
+
+    def query_run_store(self) -> DiskCache:
+        if not hasattr(self, "query_runs"):
+            self.query_runs = DiskCache(self.cache_folder / QUERY_RUNS_CACHE_NAME)
+        return self.query_runs
+
+    def materialise_runs(self, experiment: int, positions: list[int], systems: list, topics: pd.DataFrame, names: list[str], save_dir: Path, **options):
+        # Writes the run of every system to save_dir under the same name and format as pt.Experiment, which then
+        # reuses it for the evaluation. With incremental=True runs are kept per system and query in the query run store,
+        # so a grown sample only retrieves the queries never run before. With workers > 1 they are retrieved on the pool.
+        save_files = [save_dir / f"{name}.res.gz" for name in names]
+        if not self.incremental:
+            jobs = {name: (position, topics) for position, name, save_file in zip(positions, names, save_files) if not save_file.exists()}
+            if self.workers > 1 and jobs:
+                for name, run in self.parallel_transform(experiment, jobs, options).items():
+                    write_run(run, save_dir / f"{name}.res.gz")
+            return
+
+        store = self.query_run_store()
+        # Rebuilding an index changes its signature, runs retrieved from the old one are not reused
+        signature = self.indexes.signature(EXPERIMENT_INDEXES[experiment])
+        stored, jobs = {}, {}
+        for position, system, name, save_file in zip(positions, systems, names, save_files):
+            # The same system on a bigger sample shares the stored queries, the sample size is not part of the key
+            system_key = re.sub(r"_sample_\d+_queries$", "", name)
+            keys = {qid: make_key(system_key, signature, qid, query) for qid, query in zip(topics["qid"], topics["query"])}
+            runs = store.get_many(keys.values())
+
+            # A run file written by an earlier call seeds the store, but only for the queries whose key (system,
+            # index signature and query text) is the one recorded next to it. Files without keys are never trusted
+            keys_file = run_keys_path(save_file)
+            if len(runs) < len(keys) and save_file.exists() and keys_file.exists():
+                with keys_file.open("r", encoding="utf-8") as file:
+                    saved_keys = json.load(file)
+                matching = [qid for qid in keys if keys[qid] not in runs and saved_keys.get(str(qid)) == keys[qid]]
+                if matching:
+                    saved = dict(tuple(pt.io.read_results(str(save_file)).groupby("qid")))
+                    seeded = {keys[qid]: saved[str(qid)][["docno", "score", "rank"]].reset_index(drop=True) for qid in matching if str(qid) in saved}
+                    store.put_many(seeded)
+                    runs.update(seeded)
+
+            missing = topics[[keys[qid] not in runs for qid in topics["qid"]]]
+            print(f"{name}: {len(topics) - len(missing)}/{len(topics)} queries already retrieved.")
+            stored[name] = (keys, runs)
+            if len(missing):
+                jobs[name] = (position, system, missing)
+
+        if self.workers > 1 and jobs:
+            new_results = self.parallel_transform(experiment, {name: (position, missing) for name, (position, _, missing) in jobs.items()}, options)
+        else:
+            new_results = {name: system.transform(missing) for name, (_, system, missing) in jobs.items()}
+
+        for name, save_file in zip(names, save_files):
+            keys, runs = stored[name]
+            if name in new_results:
+                results_by_qid = dict(tuple(new_results[name].groupby("qid")))
+                new_runs = {}
+                for qid in jobs[name][2]["qid"]:
+                    # Queries without results are stored too, they are not retrieved again
+                    run = results_by_qid.get(qid, pd.DataFrame(columns=["docno", "score", "rank"]))
+                    new_runs[keys[qid]] = run[["docno", "score", "rank"]].reset_index(drop=True)
+                store.put_many(new_runs)
+                runs.update(new_runs)
+            run = pd.concat([runs[keys[qid]].assign(qid=qid) for qid in topics["qid"]], ignore_index=True)
+            write_run(run[["qid", "docno", "score", "rank"]], save_file)
+            keys_file = run_keys_path(save_file)
+            with keys_file.with_suffix(".tmp").open("w", encoding="utf-8") as file:
+                json.dump({str(qid): key for qid, key in keys.items()}, file)
+            os.replace(keys_file.with_suffix(".tmp"), keys_file)
+
+    def experiment_pipelines(self, experiment: int, cached=True, **options) -> list:
+        # (name, pipeline, expanded_queries) of every system of experiments 1-6, built as in run_experiment_N.
+        # cached=False leaves out the run, embedding and MonoT5 score caches, e.g. to measure latency.
+        # options are the extra arguments of run_experiment_5 (dense_mode, ANN params) and run_experiment_6 (monot5_cpu_mode, MonoT5 options)
+        indexes = self.indexes
+        if experiment in [1, 2]:
+            bm25 = indexes.retriever("basic_index", wmodel="BM25", cached=cached)
+            tfidf = indexes.retriever("basic_index", wmodel="TF_IDF", cached=cached)
+            return [
+                ("bm25", bm25, experiment == 2),
+                ("bm25_rm3", bm25 >> pt.rewrite.RM3(indexes.basic_index) >> bm25, experiment == 2),
+                ("tfidf", tfidf, experiment == 2),
+                ("tfidf_rm3", tfidf >> pt.rewrite.RM3(indexes.basic_index) >> tfidf, experiment == 2),
+            ]
+        if experiment == 3:
+            bm25 = indexes.retriever("keywords_expanded_index", wmodel="BM25", cached=cached)
+            rm3_pipe_bm25 = bm25 >> pt.rewrite.RM3(indexes.keywords_expanded_index) >> bm25
+            return [
+                ("3A_bm25", bm25, False),
+                ("3A_bm25_rm3", rm3_pipe_bm25, False),
+                ("3B_bm25", bm25, True),
+                ("3B_bm25_rm3", rm3_pipe_bm25, True),
+            ]
+        if experiment == 4:
+            return [
+                (name, indexes.retriever("two_fields_index", wmodel="BM25F", controls=controls, cached=cached), False)
+                for name, controls in [
+                    ("bm25f_keywords", {'w.0' : 0, 'w.1' : 1}),
+                    ("bm25f_text", {'w.0' : 1, 'w.1' : 0}),
+                    ("bm25f_combination", {'w.0' : 0.7, 'w.1' : 0.3}),
+                ]
+            ]
+        if experiment == 5:
+            bm25 = indexes.retriever("basic_index", wmodel="BM25", cached=cached)
+            model = indexes.query_encoder(cached)
+            ann_params = {name: value for name, value in options.items() if name != "dense_mode"}
+            return [
+                ("biencoder", model >> indexes.dense_retriever(options.get("dense_mode", "exhaustive"), **ann_params), False),
+                ("bm25_biencoder", (bm25 % 1000) >> model >> indexes.dense_scorer(), False),
+            ]
+        if experiment == 6:
+            bm25 = indexes.retriever("basic_index", wmodel="BM25", cached=cached)
+            cpu_mode = options.get("monot5_cpu_mode", False)
+            monot5_options = {name: value for name, value in options.items() if name != "monot5_cpu_mode"}
+            if cached:
+                monoT5 = cached_monot5(DiskCache(self.cache_folder / MONOT5_CACHE_NAME), batch_size = 16, cpu_mode = cpu_mode, **monot5_options)
+            else:
+                monoT5 = load_monot5(batch_size = 16, cpu_mode = cpu_mode, **monot5_options)
+            return [("bm25_monoT5", (bm25 % 100) >> indexes.text_loader() >> monoT5, False)]
+        raise ValueError("experiment must be between 1 and 6")
+
     def run_experiment_1(self, test_on_sample=True):
         if not hasattr(self.indexes, "basic_index"):
             raise RuntimeError("To run this experiment basic_index must be loaded, try load_basic_index()")
         
-        bm25 = pt.terrier.Retriever(self.indexes.basic_index, wmodel="BM25")
+        bm25 = self.indexes.retriever("basic_index", wmodel="BM25")
         rm3_pipe_bm25 = bm25 >> pt.rewrite.RM3(self.indexes.basic_index) >> bm25
 
-        tfidf = pt.terrier.Retriever(self.indexes.basic_index, wmodel="TF_IDF")
+        tfidf = self.indexes.retriever("basic_index", wmodel="TF_IDF")
         rm3_pipe_tfidf = tfidf >> pt.rewrite.RM3(self.indexes.basic_index) >> tfidf
         
         if test_on_sample:
@@ -71,10 +297,12 @@ class BenchmarkExperiments():
         save_dir = self.results_folder / "experiment_1"
         save_dir.mkdir(parents=True, exist_ok=True)
 
+        systems = self.instrumented([bm25, rm3_pipe_bm25, tfidf, rm3_pipe_tfidf], names)
+        self.materialise_runs(1, [0, 1, 2, 3], systems, queries_to_use, names, save_dir)
         experiment1_results = pt.Experiment(
-            [bm25, rm3_pipe_bm25, tfidf, rm3_pipe_tfidf],
+            systems,
             queries_to_use,
-            self.collection.qrels,
+            self.collection.qrels_for(queries_to_use["qid"]),
             EVAL_METRICS,
             verbose=True,
             names =names,
@@ -83,15 +311,16 @@ class BenchmarkExperiments():
             save_format="trec"
         )
         print(experiment1_results)
+        print("Run cache:", self.indexes.run_cache_stats())
     
     def run_experiment_2(self, test_on_sample=True):
         if not hasattr(self.indexes, "basic_index"):
             raise RuntimeError("To run this experiment basic_index must be loaded, try load_basic_index()")
         
-        bm25 = pt.terrier.Retriever(self.indexes.basic_index, wmodel="BM25")
+        bm25 = self.indexes.retriever("basic_index", wmodel="BM25")
         rm3_pipe_bm25 = bm25 >> pt.rewrite.RM3(self.indexes.basic_index) >> bm25
 
-        tfidf = pt.terrier.Retriever(self.indexes.basic_index, wmodel="TF_IDF")
+        tfidf = self.indexes.retriever("basic_index", wmodel="TF_IDF")
         rm3_pipe_tfidf = tfidf >> pt.rewrite.RM3(self.indexes.basic_index) >> tfidf
 
         if test_on_sample:
@@ -120,10 +349,12 @@ class BenchmarkExperiments():
         save_dir.mkdir(parents=True, exist_ok=True)
             
         expanded_queries = self.thesaurus_query_expansion(queries_to_use)
+        systems = self.instrumented([bm25, rm3_pipe_bm25, tfidf, rm3_pipe_tfidf], names)
+        self.materialise_runs(2, [0, 1, 2, 3], systems, expanded_queries, names, save_dir)
         experiment2_results = pt.Experiment(
-            [bm25, rm3_pipe_bm25, tfidf, rm3_pipe_tfidf],
+            systems,
             expanded_queries,
-            self.collection.qrels,
+            self.collection.qrels_for(queries_to_use["qid"]),
             EVAL_METRICS,
             verbose=True,
             names=names,
@@ -132,12 +363,13 @@ class BenchmarkExperiments():
             save_format="trec"
             )
         print(experiment2_results)
+        print("Run cache:", self.indexes.run_cache_stats())
     
     def run_experiment_3(self, test_on_sample=True):
         if not hasattr(self.indexes, "keywords_expanded_index"):
             raise RuntimeError("To run this experiment keywords_expanded_index must be loaded, try load_keywords_expanded_index()")
         
-        bm_25 = pt.terrier.Retriever(self.indexes.keywords_expanded_index, wmodel="BM25")
+        bm_25 = self.indexes.retriever("keywords_expanded_index", wmodel="BM25")
         rm3_pipe_bm25 = bm_25 >> pt.rewrite.RM3(self.indexes.keywords_expanded_index) >> bm_25
 
         if test_on_sample:
@@ -169,10 +401,12 @@ class BenchmarkExperiments():
         save_dir = self.results_folder / "experiment_3"
         save_dir.mkdir(parents=True, exist_ok=True)
         
+        systems = self.instrumented([bm_25, rm3_pipe_bm25], names_a)
+        self.materialise_runs(3, [0, 1], systems, queries_to_use, names_a, save_dir)
         experiment3_results_a = pt.Experiment(
-            [bm_25, rm3_pipe_bm25],
+            systems,
             queries_to_use,
-            self.collection.qrels,
+            self.collection.qrels_for(queries_to_use["qid"]),
             EVAL_METRICS,
             verbose=True,
             names=names_a,
@@ -183,10 +417,12 @@ class BenchmarkExperiments():
         print("Original queries\n", experiment3_results_a)
         
         expanded_queries = self.thesaurus_query_expansion(queries_to_use)
+        systems = self.instrumented([bm_25, rm3_pipe_bm25], names_b)
+        self.materialise_runs(3, [2, 3], systems, expanded_queries, names_b, save_dir)
         experiment3_results_b = pt.Experiment(
-            [bm_25, rm3_pipe_bm25],
+            systems,
             expanded_queries,
-            self.collection.qrels,
+            self.collection.qrels_for(queries_to_use["qid"]),
             EVAL_METRICS,
             verbose=True,
             names=names_b,
@@ -195,17 +431,18 @@ class BenchmarkExperiments():
             save_format="trec"
             )
         print("Expanded queries\n", experiment3_results_b)
+        print("Run cache:", self.indexes.run_cache_stats())
 
     def run_experiment_4(self, test_on_sample=True):
         if not hasattr(self.indexes, "two_fields_index"):
             raise RuntimeError("To run this experiment two_fields_index must be loaded, try load_two_fields_index()")
 
         # Matching only with keywords
-        bm25f_keywords = pt.terrier.Retriever(self.indexes.two_fields_index, wmodel="BM25F", controls = {'w.0' : 0, 'w.1' : 1})
+        bm25f_keywords = self.indexes.retriever("two_fields_index", wmodel="BM25F", controls={'w.0' : 0, 'w.1' : 1})
         # Matching only with text
-        bm25f_text = pt.terrier.Retriever(self.indexes.two_fields_index, wmodel="BM25F", controls = {'w.0' : 1, 'w.1' : 0})
+        bm25f_text = self.indexes.retriever("two_fields_index", wmodel="BM25F", controls={'w.0' : 1, 'w.1' : 0})
         # Combination of the two fileds
-        bm25f_combination = pt.terrier.Retriever(self.indexes.two_fields_index, wmodel="BM25F", controls = {'w.0' : 0.7, 'w.1' : 0.3})
+        bm25f_combination = self.indexes.retriever("two_fields_index", wmodel="BM25F", controls={'w.0' : 0.7, 'w.1' : 0.3})
 
         if test_on_sample:
             if not hasattr(self.collection, "queries_sample"):
@@ -226,10 +463,12 @@ class BenchmarkExperiments():
         save_dir = self.results_folder / "experiment_4"
         save_dir.mkdir(parents=True, exist_ok=True)
 
+        systems = self.instrumented([bm25f_keywords], names_kw)
+        self.materialise_runs(4, [0], systems, queries_to_use, names_kw, save_dir)
         experiment4_results_kw = pt.Experiment(
-            [bm25f_keywords],
+            systems,
             queries_to_use,
-            self.collection.qrels,
+            self.collection.qrels_for(queries_to_use["qid"]),
             EVAL_METRICS,
             verbose=True,
             names=names_kw,
@@ -239,10 +478,12 @@ class BenchmarkExperiments():
         )
         print("BM25F on keywords\n", experiment4_results_kw)
 
+        systems = self.instrumented([bm25f_text], names_txt)
+        self.materialise_runs(4, [1], systems, queries_to_use, names_txt, save_dir)
         experiment4_results_txt = pt.Experiment(
-            [bm25f_text],
+            systems,
             queries_to_use,
-            self.collection.qrels,
+            self.collection.qrels_for(queries_to_use["qid"]),
             EVAL_METRICS,
             verbose=True,
             names=names_txt,
@@ -252,10 +493,12 @@ class BenchmarkExperiments():
         )
         print("BM25F on text\n", experiment4_results_txt)
 
+        systems = self.instrumented([bm25f_combination], names_comb)
+        self.materialise_runs(4, [2], systems, queries_to_use, names_comb, save_dir)
         experiment4_results_comb = pt.Experiment(
-            [bm25f_combination],
+            systems,
             queries_to_use,
-            self.collection.qrels,
+            self.collection.qrels_for(queries_to_use["qid"]),
             EVAL_METRICS,
             verbose=True,
             names=names_comb,
@@ -264,17 +507,22 @@ class BenchmarkExperiments():
             save_format="trec"
         )
         print("BM25F on combination\n", experiment4_results_comb)
+        print("Run cache:", self.indexes.run_cache_stats())
 
-    def run_experiment_5(self, test_on_sample=True):
+    def run_experiment_5(self, test_on_sample=True, dense_mode="exhaustive", **ann_params):
         if not(hasattr(self.indexes, "basic_index") and hasattr(self.indexes, "dense_index")):
             raise RuntimeError("To run this experiment basic_index and dense_index must be loaded, try load_basic_index() and load_dense_index")
         
-        bm25 = pt.terrier.Retriever(self.indexes.basic_index, wmodel="BM25")
-        model = RetroMAE.msmarco_distill()
+        bm25 = self.indexes.retriever("basic_index", wmodel="BM25")
+        # Shared query encoder, each query is embedded once for both pipelines
+        model = self.indexes.query_encoder()
 
-        retrieval_pipe_biencoder = model >> self.indexes.dense_index.retriever()
-        scorer_pipe_biencoder = model >> self.indexes.dense_index.scorer()
+        # dense_mode="ivf" or "hnsw" swaps the exhaustive scan for approximate search, see BenchmarkIndex.dense_retriever
+        retrieval_pipe_biencoder = model >> self.indexes.dense_retriever(dense_mode, **ann_params)
+        scorer_pipe_biencoder = model >> self.indexes.dense_scorer()
         retrieval_pipe_bm25_biencoder = (bm25 % 1000) >> scorer_pipe_biencoder
+        # Approximate runs are saved under their own name, so save_mode="reuse" never mixes them with exhaustive ones
+        suffix = "" if dense_mode == "exhaustive" else f"_{dense_mode}" + "".join(f"_{name}_{value}" for name, value in sorted(ann_params.items()))
 
         if test_on_sample:
             if not hasattr(self.collection, "queries_sample"):
@@ -283,24 +531,26 @@ class BenchmarkExperiments():
             queries_to_use = self.collection.queries_sample
             print(f"Running Experiment 5 on sampled queries ({len(queries_to_use)} queries).")
             names = [
-                f"experiment5_biencoder_sample_{len(queries_to_use)}_queries",
+                f"experiment5_biencoder{suffix}_sample_{len(queries_to_use)}_queries",
                 f"experiment5_bm25_biencoder_sample_{len(queries_to_use)}_queries"
             ]
         else:
             queries_to_use = self.collection.queries
             print(f"Running Experiment 5 on full query set ({len(queries_to_use)} queries).")
             names = [
-                "experiment5_biencoder",
+                f"experiment5_biencoder{suffix}",
                 "experiment5_bm25_biencoder"
             ]
         
         save_dir = self.results_folder / "experiment_5"
         save_dir.mkdir(parents=True, exist_ok=True)
 
+        systems = self.instrumented([retrieval_pipe_biencoder, retrieval_pipe_bm25_biencoder], names)
+        self.materialise_runs(5, [0, 1], systems, queries_to_use, names, save_dir, dense_mode=dense_mode, **ann_params)
         experiment5_results = pt.Experiment(
-            [retrieval_pipe_biencoder, retrieval_pipe_bm25_biencoder],
+            systems,
             queries_to_use,
-            self.collection.qrels,
+            self.collection.qrels_for(queries_to_use["qid"]),
             EVAL_METRICS,
             verbose=True,
             names=names,
@@ -309,15 +559,20 @@ class BenchmarkExperiments():
             save_format="trec"
         )           
         print(experiment5_results)
+        print("Run cache:", self.indexes.run_cache_stats())
+        print("Query embeddings:", model.stats())
     
-    def run_experiment_6(self, test_on_sample=True):
+    def run_experiment_6(self, test_on_sample=True, monot5_cpu_mode=False, **monot5_options):
         if not(hasattr(self.indexes, "basic_index") and hasattr(self.indexes, "dense_index")):
             raise RuntimeError("To run this experiment basic_index and dense_index must be loaded, try load_basic_index() and load_dense_index")
         
-        bm25 = pt.terrier.Retriever(self.indexes.basic_index, wmodel="BM25")
-        monoT5 = MonoT5ReRanker(batch_size = 16)
+        bm25 = self.indexes.retriever("basic_index", wmodel="BM25")
+        monoT5 = cached_monot5(DiskCache(self.cache_folder / MONOT5_CACHE_NAME), batch_size = 16, cpu_mode = monot5_cpu_mode, **monot5_options)
 
-        mono_pipe = (bm25 % 100) >> (pt.text.get_text(self.indexes.basic_index, "text")) >> monoT5
+        mono_pipe = (bm25 % 100) >> (self.indexes.text_loader()) >> monoT5
+        # CPU mode runs are saved under their own name, their scores differ slightly from the float32 ones.
+        # The CPU options (quantization, threads) are part of the name, so different settings never share runs
+        suffix = "_cpu" + "".join(f"_{name}_{value}" for name, value in sorted(monot5_options.items())) if monot5_cpu_mode else ""
 
         if test_on_sample:
             if not hasattr(self.collection, "queries_sample"):
@@ -326,22 +581,24 @@ class BenchmarkExperiments():
             queries_to_use = self.collection.queries_sample
             print(f"Running Experiment 6 on sampled queries ({len(queries_to_use)} queries).")
             names = [
-                f"experiment5_bm25_monoT5_sample_{len(queries_to_use)}_queries"
+                f"experiment5_bm25_monoT5{suffix}_sample_{len(queries_to_use)}_queries"
             ]
         else:
             queries_to_use = self.collection.queries
             print(f"Running Experiment 6 on full query set ({len(queries_to_use)} queries).")
             names = [
-                "experiment5_bm25_monoT5"
+                f"experiment5_bm25_monoT5{suffix}"
             ]
         
         save_dir = self.results_folder / "experiment_6"
         save_dir.mkdir(parents=True, exist_ok=True)
 
+        systems = self.instrumented([mono_pipe], names)
+        self.materialise_runs(6, [0], systems, queries_to_use, names, save_dir, monot5_cpu_mode=monot5_cpu_mode, **monot5_options)
         experiment6_results = pt.Experiment(
-            [mono_pipe],
+            systems,
             queries_to_use,
-            self.collection.qrels,
+            self.collection.qrels_for(queries_to_use["qid"]),
             EVAL_METRICS,
             verbose=True,
             names=names,
@@ -349,4 +606,102 @@ class BenchmarkExperiments():
             save_mode="reuse",
             save_format="trec"
         )
-        print(experiment6_results)
\ No newline at end of file
+        print(experiment6_results)
+        print("Run cache:", self.indexes.run_cache_stats())
+        print("MonoT5 score cache:", monoT5.stats())
+
+    def rerank_cascade(self, monoT5, prefilter=None, top_n=100, ratio=0.8, max_windows=1):
+        # BM25 top 100, narrowed by a cheap prefilter, then MonoT5 on what is left:
+        # prefilter=None      every candidate goes to MonoT5 (experiment 6)
+        # prefilter="dense"   RetroMAE scores the candidates, only the top_n reach MonoT5
+        # prefilter="ratio"   candidates under ratio * the best BM25 score are dropped, at most top_n are kept
+        # prefilter="windows" documents are split in sliding windows and only the first max_windows of each are scored
+        # Built without the run and query embedding caches, mrt has to include the retrieval and the query encoding
+        bm25 = self.indexes.retriever("basic_index", wmodel="BM25", cached=False) % 100
+        get_text = self.indexes.text_loader()
+        if prefilter is None:
+            return bm25 >> get_text >> monoT5
+        if prefilter == "dense":
+            dense_scorer = self.indexes.query_encoder(cached=False) >> self.indexes.dense_scorer()
+            return bm25 >> dense_scorer % top_n >> get_text >> monoT5
+        if prefilter == "ratio":
+            return bm25 >> ScoreRatioFilter(ratio) % top_n >> get_text >> monoT5
+        if prefilter == "windows":
+            sliding = pt.text.sliding(length=256, stride=128, text_attr="text", prepend_attr=None)
+            return bm25 >> get_text >> sliding >> FirstPassages(max_windows) >> monoT5 >> pt.text.max_passage()
+        raise ValueError("prefilter must be None, 'dense', 'ratio' or 'windows'")
+
+    def run_experiment_7(self, test_on_sample=True, cascades=None, monot5_cpu_mode=False, **monot5_options):
+        if not(hasattr(self.indexes, "basic_index") and hasattr(self.indexes, "dense_index")):
+            raise RuntimeError("To run this experiment basic_index and dense_index must be loaded, try load_basic_index() and load_dense_index")
+
+        if cascades is None:
+            cascades = [
+                {"prefilter": None},
+                {"prefilter": "dense", "top_n": 50},
+                {"prefilter": "dense", "top_n": 20},
+                {"prefilter": "dense", "top_n": 10},
+                {"prefilter": "ratio", "ratio": 0.8, "top_n": 50},
+                {"prefilter": "windows", "max_windows": 1},
+            ]
+
+        # No score cache here either, the latency of every cascade has to include all its MonoT5 calls
+        monoT5 = load_monot5(batch_size = 16, cpu_mode = monot5_cpu_mode, **monot5_options)
+        pipelines = [self.rerank_cascade(monoT5, **cascade) for cascade in cascades]
+        cascade_names = ["_".join(str(value) for value in cascade.values()) if cascade.get("prefilter") else "no_prefilter" for cascade in cascades]
+
+        if test_on_sample:
+            if not hasattr(self.collection, "queries_sample"):
+                raise RuntimeError("No sampled queries available. Call sample_queries() first.")
+
+            queries_to_use = self.collection.queries_sample
+            print(f"Running Experiment 7 on sampled queries ({len(queries_to_use)} queries).")
+            names = [f"experiment7_bm25_{name}_monoT5_sample_{len(queries_to_use)}_queries" for name in cascade_names]
+        else:
+            queries_to_use = self.collection.queries
+            print(f"Running Experiment 7 on full query set ({len(queries_to_use)} queries).")
+            names = [f"experiment7_bm25_{name}_monoT5" for name in cascade_names]
+
+        save_dir = self.results_folder / "experiment_7"
+        save_dir.mkdir(parents=True, exist_ok=True)
+
+        # Runs are always recomputed: mrt (mean response time in ms) would be meaningless for runs read back from disk
+        experiment7_results = pt.Experiment(
+            self.instrumented(pipelines, names),
+            queries_to_use,
+            self.collection.qrels_for(queries_to_use["qid"]),
+            EVAL_METRICS + ["mrt"],
+            verbose=True,
+            names=names,
+            save_dir=save_dir,
+            save_mode="overwrite",
+            save_format="trec"
+        )
+        print(experiment7_results)
+
+# State of a process pool worker, set up once by init_experiment_worker
+_worker_experiments = None
+_worker_pipelines = {}
+
+def init_experiment_worker(collection_paths, folders, index_names, dense_precision):
+    global _worker_experiments
+    indexes_folder, results_folder, cache_folder = folders
+    collection = BenchmarkCollection(*collection_paths)
+    collection.load_queries()
+    collection.load_qrels()
+    # Read-only: the workers never delete the files retired by a merge, the parent may still have them open
+    indexes = BenchmarkIndex(collection, indexes_folder=indexes_folder, cache_folder=cache_folder, read_only=True)
+    for index_name in index_names:
+        if index_name == "dense_index":
+            indexes.load_dense_index(dense_precision)
+        else:
+            getattr(indexes, f"load_{index_name}")()
+    _worker_experiments = BenchmarkExperiments(collection, indexes, results_folder=results_folder, cache_folder=cache_folder)
+
+def run_experiment_shard(experiment: int, position: int, topics: pd.DataFrame, options: dict) -> pd.DataFrame:
+    # The pipelines of an experiment are built once per worker and reused by all its shards
+    key = make_key(experiment, options)
+    if key not in _worker_pipelines:
+        _worker_pipelines[key] = _worker_experiments.experiment_pipelines(experiment, **options)
+    _, pipeline, _ = _worker_pipelines[key][position]
+    return pipeline.transform(topics)
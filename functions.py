@@ -2,10 +2,31 @@
 # nltk.download('punkt')
 # nltk.download('wordnet')
 # nltk.download('stopwords')
+from collections import OrderedDict
+from pathlib import Path
+from caches import DiskCache
+
+# Keyword extraction models are loaded once per process and reused
+_KEYWORDS_MODELS = {}
+
+def get_keywords_model(method: str):
+    if method not in ['rake', 'bert']:
+        raise ValueError("Method must be either 'rake' or 'bert'")
+    
+    if method not in _KEYWORDS_MODELS:
+        if method == 'rake':
+            from rake_nltk import Rake
+            _KEYWORDS_MODELS[method] = Rake()
+        if method == 'bert':
+            from keybert import KeyBERT
+            _KEYWORDS_MODELS[method] = KeyBERT()
+    return _KEYWORDS_MODELS[method]
+
+def clear_keywords_models():
+    _KEYWORDS_MODELS.clear()
 
 def keywords_extraction_RAKE(text: str, max_keywords: int) -> list[str]:
-    from rake_nltk import Rake
-    r = Rake()
+    r = get_keywords_model('rake')
     r.extract_keywords_from_text(text)
     phrases = r.get_ranked_phrases()
     
@@ -19,14 +40,27 @@ def keywords_extraction_RAKE(text: str, max_keywords: int) -> list[str]:
     return list(words)
 
 def keywords_extraction_BERT(text: str, max_keywords: int) -> list[str]:
-    from keybert import KeyBERT
-    kwBert = KeyBERT()
+    kwBert = get_keywords_model('bert')
     keywords = kwBert.extract_keywords(text, keyphrase_ngram_range=(1, 1), stop_words='english', top_n=max_keywords)
     kw = []
     for k in keywords:
         kw.append(k[0])
     return kw
 
+def keywords_extraction_BERT_batch(texts: list[str], max_keywords: int, batch_size=256) -> list[list[str]]:
+    kwBert = get_keywords_model('bert')
+    all_keywords = []
+    for start in range(0, len(texts), batch_size):
+        batch = texts[start:start + batch_size]
+        # KeyBERT embeds all documents and all candidate words of the batch together
+        keywords = kwBert.extract_keywords(batch, keyphrase_ngram_range=(1, 1), stop_words='english', top_n=max_keywords)
+        # KeyBERT unwraps the result when it receives a single document
+        if len(batch) == 1:
+            keywords = [keywords]
+        for doc_keywords in keywords:
+            all_keywords.append([k[0] for k in doc_keywords])
+    return all_keywords
+
 def keywords_extractor(text: str, max_keywords=3, method='rake') -> list[str]:
     if method not in ['rake', 'bert']:
         raise ValueError("Method must be either 'rake' or 'bert'")
@@ -39,19 +73,96 @@ def keywords_extractor(text: str, max_keywords=3, method='rake') -> list[str]:
         keywords = keywords_extraction_BERT(text, max_keywords)
         return keywords
 
-def thesaurus_based_expansion(text: str, keywords: list[str], max_synonyms_per_keyword=2) -> list[str]:
-    from nltk.wsd import lesk
+def keywords_extractor_batch(texts: list[str], max_keywords=3, method='rake', batch_size=256) -> list[list[str]]:
+    # Same output as calling keywords_extractor on every text, one list of keywords per text
+    if method not in ['rake', 'bert']:
+        raise ValueError("Method must be either 'rake' or 'bert'")
+    
+    if method == 'rake':
+        return [keywords_extraction_RAKE(text, max_keywords) for text in texts]
+    
+    if method == 'bert':
+        return keywords_extraction_BERT_batch(list(texts), max_keywords, batch_size)
+
+class SynonymCache():
+    # WordNet senses of a word as (synset name, definition tokens, lemma names), looked up
+    # in a bounded in-memory LRU first, then in the optional on-disk synonym table, then in WordNet
+    def __init__(self, maxsize=100_000, table_path=None):
+        self.maxsize = maxsize
+        self.senses = OrderedDict()
+        self.table_path = Path(table_path) if table_path else None
+        self.table = DiskCache(self.table_path) if self.table_path else None
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def word_senses(self, word: str) -> list[tuple]:
+        if word in self.senses:
+            self.hits += 1
+            self.senses.move_to_end(word)
+            return self.senses[word]
+
+        senses = self.table.get(word) if self.table is not None else None
+        if senses is not None:
+            self.disk_hits += 1
+        else:
+            from nltk.corpus import wordnet
+            self.misses += 1
+            senses = [
+                (ss.name(), frozenset(ss.definition().split()), [lemma.name() for lemma in ss.lemmas()])
+                for ss in wordnet.synsets(word)
+            ]
+            if self.table is not None:
+                self.table.put(word, senses)
+
+        self.senses[word] = senses
+        if len(self.senses) > self.maxsize:
+            self.senses.popitem(last=False)
+        return senses
+
+    def lesk(self, context: set, word: str):
+        # Same choice as nltk.wsd.lesk: first sense with the largest definition overlap
+        senses = self.word_senses(word)
+        if not senses:
+            return None
+        return max(senses, key=lambda sense: len(context.intersection(sense[1])))
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            "memory_hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+        }
+
+_SYNONYM_CACHE = None
+
+def get_synonym_cache(table_path=None) -> SynonymCache:
+    # One cache per process, replaced only when a different synonym table is requested
+    global _SYNONYM_CACHE
+    if _SYNONYM_CACHE is None or (table_path is not None and _SYNONYM_CACHE.table_path != Path(table_path)):
+        _SYNONYM_CACHE = SynonymCache(table_path=table_path)
+    return _SYNONYM_CACHE
+
+def thesaurus_based_expansion(text: str, keywords: list[str], max_synonyms_per_keyword=2, synonym_cache: SynonymCache | None = None) -> list[str]:
     from nltk import word_tokenize
 
+    if synonym_cache is None:
+        synonym_cache = get_synonym_cache()
+
+    # The context is the same for every keyword of the text
+    context = set(word_tokenize(text))
+
     expanded_keywords = []
     for kw in keywords:
-        synset = lesk(word_tokenize(text), kw)
+        sense = synonym_cache.lesk(context, kw)
 
-        if synset:
+        if sense:
             synonyms = set()
-            for lemma in synset.lemmas():
-                if lemma.name().lower() != kw.lower():
-                    synonyms.add(lemma.name().replace('_', ' '))
+            for lemma_name in sense[2]:
+                if lemma_name.lower() != kw.lower():
+                    synonyms.add(lemma_name.replace('_', ' '))
                 if len(synonyms) >= max_synonyms_per_keyword:
                     break
 
@@ -63,6 +174,15 @@ def thesaurus_based_expansion(text: str, keywords: list[str], max_synonyms_per_k
     
     return expanded_keywords
 
+def expand_texts(texts: list[str], max_keywords=3, method='rake', max_synonyms_per_keyword=2, synonym_table=None) -> list[str]:
+    # Keywords + synonyms for each text, joined as the string that gets indexed.
+    # Top-level so it can be shipped to a process pool.
+    synonym_cache = get_synonym_cache(synonym_table)
+    expansions = []
+    for text, keywords in zip(texts, keywords_extractor_batch(texts, max_keywords, method)):
+        expansions.append(" ".join(thesaurus_based_expansion(text, keywords, max_synonyms_per_keyword, synonym_cache)))
+    return expansions
+
 class TokenizerWrapper:
     # Tokenizer that actually works with py.sliding
     def __init__(self, tok):
@@ -1,175 +1,708 @@
 from collection import BenchmarkCollection
+import json
+import os
+import shutil
+import threading
+import multiprocessing
+import numpy as np
 import pyterrier as pt
+from concurrent.futures import ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
 from tqdm import tqdm
 from pathlib import Path
-from functions import keywords_extractor, thesaurus_based_expansion
-from constants import BASIC_INDEX_NAME, KEYWORDS_INDEX_NAME, TWO_FIELDS_INDEX_NAME, INDEXES_FOLDER, DENSE_INDEX_NAME
-from pyterrier_dr import FlexIndex, RetroMAE
+from functions import expand_texts
+from caches import DiskCache
+from pipelines import CachedRetriever, CachedQueryEncoder
+# pyterrier_dr (and torch with it), the dense and docstore modules are imported by the methods that use them,
+# loading the sparse indexes does not pay for them
+from constants import BASIC_INDEX_NAME, KEYWORDS_INDEX_NAME, TWO_FIELDS_INDEX_NAME, INDEXES_FOLDER, DENSE_INDEX_NAME, EXPANSION_FOLDER, DELTA_SEGMENTS_FOLDER, DOCUMENT_STORE_NAME, DOCUMENT_STORE_BLOCK_SIZE, EXPANSION_CHUNK_SIZE, INDEXING_THREADS, CACHE_FOLDER, SYNONYM_TABLE_NAME, RUN_CACHE_NAME, QUERY_EMBEDDING_CACHE_NAME, DENSE_MODEL_NAME, DENSE_CHECKPOINTS_FOLDER, DENSE_CHECKPOINT_SIZE
+
+# Index type -> folder of the index, the same types are accepted by add_documents() and merge_segments()
+INDEX_TYPES = {
+    "basic": BASIC_INDEX_NAME,
+    "keywords_expanded": KEYWORDS_INDEX_NAME,
+    "two_fields": TWO_FIELDS_INDEX_NAME,
+    "dense": DENSE_INDEX_NAME,
+}
 
 class BenchmarkIndex():
-    def __init__(self, collection: BenchmarkCollection, indexes_folder=INDEXES_FOLDER):
+    # read_only=True (process pool workers) only loads and searches: no new segments, merges or deletions
+    def __init__(self, collection: BenchmarkCollection, indexes_folder=INDEXES_FOLDER, cache_folder=CACHE_FOLDER, read_only=False):
         self.collection = collection
+        self.read_only = read_only
         self.indexes_folder = Path(indexes_folder).resolve()
+        self.cache_folder = Path(cache_folder).resolve()
+        self.segments_lock = threading.Lock()    # delta manifests are also updated by background merges
+        self.merges = {}
+        self.merged = set()    # indexes merged by this process, the only one that deletes what the merge retired
         self.create_indexes_folder()
     
     def create_indexes_folder(self):
         self.indexes_folder.mkdir(parents=True, exist_ok=True)
 
-    def create_basic_index(self):
+    def retriever(self, index_name: str, wmodel="BM25", controls=None, num_results=1000, cached=True):
+        # Terrier retriever on a loaded index, with its runs shared through the on-disk run cache.
+        # cached=False gives the plain Terrier retriever, e.g. to measure retrieval latency
+        if not hasattr(self, index_name):
+            raise RuntimeError(f"{index_name} is not loaded, try load_{index_name}()")
+        if not cached:
+            return pt.terrier.Retriever(getattr(self, index_name), wmodel=wmodel, controls=controls or {}, num_results=num_results)
+        if not hasattr(self, "run_cache"):
+            self.run_cache = DiskCache(self.cache_folder / RUN_CACHE_NAME)
+            self.cached_retrievers = []
+        retriever = CachedRetriever(getattr(self, index_name), index_name, self.run_cache, self.build_key(index_name), wmodel=wmodel, controls=controls, num_results=num_results)
+        self.cached_retrievers.append(retriever)
+        return retriever
+
+    def query_encoder(self, cached=True):
+        # One RetroMAE query encoder shared by every dense pipeline, so each query is embedded once.
+        # cached=False gives the same model without the embedding cache
+        if not hasattr(self, "dense_model"):
+            from pyterrier_dr import RetroMAE
+            self.dense_model = RetroMAE.msmarco_distill()
+        if not cached:
+            return self.dense_model
+        if not hasattr(self, "dense_query_encoder"):
+            cache = DiskCache(self.cache_folder / QUERY_EMBEDDING_CACHE_NAME)
+            self.dense_query_encoder = CachedQueryEncoder(self.dense_model, DENSE_MODEL_NAME, cache)
+        return self.dense_query_encoder
+
+    def dense_retriever(self, mode="exhaustive", num_results=1000, n_list=None, n_probe=16, neighbours=32, ef_construction=40, ef_search=64):
+        # First stage retriever over the dense index.
+        # "exhaustive" scores every document vector, "ivf" only scans the n_probe closest of n_list clusters
+        # and "hnsw" walks a neighbour graph (ef_search candidates). More probes / candidates = higher recall, more latency.
+        # The FAISS structures are built on first use and kept next to the index, one set per vector precision.
+        if not hasattr(self, "dense_index"):
+            raise RuntimeError("dense_index is not loaded, try load_dense_index()")
+        if mode == "exhaustive":
+            return self.dense_index.retriever(num_results=num_results)
+        if mode == "ivf":
+            return self.dense_index.faiss_ivf_retriever(num_results=num_results, n_list=n_list, n_probe=n_probe)
+        if mode == "hnsw":
+            return self.dense_index.faiss_hnsw_retriever(neighbours, num_results=num_results, ef_construction=ef_construction, ef_search=ef_search)
+        raise ValueError("mode must be one of ['exhaustive', 'ivf', 'hnsw']")
+
+    def build_key(self, index_name: str) -> list:
+        # Size and modification time of every file of a Terrier index and its delta segments. A rebuild of the
+        # same corpus has the same collection statistics but can number the documents differently (threads>1)
+        paths = [self.indexes_folder / index_name] + [segment_path for segment_path, _ in self.delta_segments(index_name)]
+        return [
+            [str(file.relative_to(self.indexes_folder)), file.stat().st_size, file.stat().st_mtime_ns]
+            for path in paths for file in sorted(path.iterdir()) if file.is_file()
+        ]
+
+    def dense_scorer(self) -> pt.Transformer:
+        # Re-scores candidates with the dense index, looked up by docno whatever index produced them
+        if not hasattr(self, "dense_index"):
+            raise RuntimeError("dense_index is not loaded, try load_dense_index()")
+        from dense import DocnoScorer
+        return DocnoScorer(self.dense_index.scorer())
+
+    def run_cache_stats(self) -> dict:
+        hits = sum(retriever.hits for retriever in getattr(self, "cached_retrievers", []))
+        misses = sum(retriever.misses for retriever in getattr(self, "cached_retrievers", []))
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / (hits + misses) if hits + misses else 0.0,
+        }
+
+    def signature(self, index_names: list[str]) -> dict:
+        # Summary of the loaded indexes that changes whenever one of them is rebuilt
+        signature = {}
+        for index_name in index_names:
+            if not hasattr(self, index_name):
+                raise RuntimeError(f"{index_name} is not loaded, try load_{index_name}()")
+            index = getattr(self, index_name)
+            if index_name == "dense_index":
+                # Document count alone does not tell a rebuild or a float32 index from a compact one
+                from dense import COMPACT_FILES
+                base = getattr(index, "base", index)
+                precision = getattr(index, "precision", None)
+                vector_files = [Path(base.index_path) / "pt_meta.json"] + [Path(base.index_path) / name for name in COMPACT_FILES.get(precision, [])]
+                signature[index_name] = {
+                    "documents": len(index),
+                    "precision": precision,
+                    "modified": [file.stat().st_mtime_ns for file in vector_files],
+                }
+            else:
+                signature[index_name] = self.build_key(index_name)
+        return signature
+
+    def iter_documents(self, streaming=False):
+        # {docno, text} dicts for the indexers, without copying the corpus.
+        # With streaming=True they are parsed straight from the json file.
+        if streaming:
+            return self.collection.iter_documents()
         if not hasattr(self.collection, "corpus_dataframe"):
-            raise RuntimeError("Documents not loaded. Call load_documents() before creating an index.")
-        longest_len = self.collection.corpus_dataframe["docno"].str.len().max()
-        longest_txt = self.collection.corpus_dataframe["text"].str.len().max()
-        
-        # Create index or raise error if it exists
-        basic_index_path = self.indexes_folder / BASIC_INDEX_NAME
-        if basic_index_path.exists():
-            raise RuntimeError(f"Index already exists: {basic_index_path}")
-        basic_index_path.mkdir(parents=True)
-
-        # Build the indexer using the pt.IterDictIndexer
-        indexer = pt.IterDictIndexer(
-        str(basic_index_path),
-        meta={"docno": longest_len, "text": longest_txt},  
-        text_attrs=["text"],    # which field(s) contain the text
-        meta_reverse=["docno"], # enable reverse lookup on docno
-        pretokenised=False,
-        fields=False,
-        threads=1, 
-        )
-
-        index_ref = indexer.index(self.collection.corpus_dataframe.to_dict(orient="records"))
+            raise RuntimeError("Documents not loaded. Call load_documents() before creating an index, or use streaming=True.")
+        corpus_dataframe = self.collection.corpus_dataframe
+        return ({"docno": docno, "text": text} for docno, text in zip(corpus_dataframe["docno"], corpus_dataframe["text"]))
 
-        # Open the index to ensure it is valid
-        index = pt.IndexFactory.of(index_ref)
+    def iter_document_chunks(self, chunk_size, streaming=False):
+        chunk = []
+        for document in self.iter_documents(streaming):
+            chunk.append(document)
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
 
-        # Print a simple summary
-        print("Index location:", basic_index_path)
-        print("Indexed documents:", index.getCollectionStatistics().getNumberOfDocuments())
-    
-    def create_keywords_expanded_index(self):
+    def corpus_lengths(self, streaming=False):
+        # Longest docno and longest text, used to size the meta fields
+        if streaming:
+            statistics = self.collection.document_statistics()
+            return statistics["longest_docno"], statistics["longest_text"]
         if not hasattr(self.collection, "corpus_dataframe"):
-            raise RuntimeError("Documents not loaded. Call load_documents() before creating an index.")
-        longest_len = self.collection.corpus_dataframe["docno"].str.len().max()
+            raise RuntimeError("Documents not loaded. Call load_documents() before creating an index, or use streaming=True.")
+        longest_len = int(self.collection.corpus_dataframe["docno"].str.len().max())
+        longest_txt = int(self.collection.corpus_dataframe["text"].str.len().max())
+        return longest_len, longest_txt
 
-        # Create index or raise error if it exists
-        keywords_expanded_index_path = self.indexes_folder / KEYWORDS_INDEX_NAME
-        if keywords_expanded_index_path.exists():
-            raise RuntimeError(f"Index already exists: {keywords_expanded_index_path}")
-        keywords_expanded_index_path.mkdir(parents=True)
-
-        corpus_dataframe = self.collection.corpus_dataframe.copy() # Make a copy to avoid modifying the original   
-        # Expand documents with keywords and synonyms
-        tqdm.pandas(desc="Expanding documents with keywords and synonyms")
-        corpus_dataframe["text"] = corpus_dataframe["text"].progress_apply(
-            lambda q: " ".join(
-                thesaurus_based_expansion(q, keywords_extractor(q)),
-            )
-        )
+    def expand_documents(self, chunk_size=EXPANSION_CHUNK_SIZE, workers=None, max_keywords=3, method="rake", max_synonyms_per_keyword=2, use_synonym_table=True, streaming=False):
+        # Every finished chunk is saved on its own, the manifest makes sure a resumed
+        # build uses the same parameters as the chunks already on disk
+        expansion_path = self.indexes_folder / EXPANSION_FOLDER
+        expansion_path.mkdir(parents=True, exist_ok=True)
+        manifest = {
+            "chunk_size": chunk_size,
+            "max_keywords": max_keywords,
+            "method": method,
+            "max_synonyms_per_keyword": max_synonyms_per_keyword,
+        }
+        manifest_path = expansion_path / "manifest.json"
+        if manifest_path.exists():
+            with manifest_path.open("r", encoding="utf-8") as file:
+                saved_manifest = json.load(file)
+            if saved_manifest != manifest:
+                raise RuntimeError(f"Expanded chunks in {expansion_path} were built with {saved_manifest}, delete the folder to rebuild them with {manifest}")
+        else:
+            with manifest_path.open("w", encoding="utf-8") as file:
+                json.dump(manifest, file)
 
-        # Build the indexer using the pt.IterDictIndexer
-        indexer = pt.IterDictIndexer(
-            str(keywords_expanded_index_path),
-            meta={"docno": longest_len},
+        def save_chunk(i, docnos, expansions):
+            # Write to a temporary file first so an interrupted write never leaves a broken chunk
+            tmp_path = self.expanded_chunk_path(i).with_suffix(".tmp")
+            with tmp_path.open("w", encoding="utf-8") as file:
+                json.dump({"docno": docnos, "expansion": expansions}, file)
+            os.replace(tmp_path, self.expanded_chunk_path(i))
+
+        synonym_table = self.cache_folder / SYNONYM_TABLE_NAME if use_synonym_table else None
+        workers = workers or os.cpu_count()
+        total = None if streaming or not hasattr(self.collection, "corpus_dataframe") else (len(self.collection.corpus_dataframe) + chunk_size - 1) // chunk_size
+        n_chunks = 0
+        reused = 0
+        # Spawned, not forked: the expansion can run inside the generator an indexer consumes, with the JVM already up
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor, tqdm(total=total, desc="Expanding documents with keywords and synonyms", unit="chunk") as progress:
+            futures = {}
+            for i, chunk in enumerate(self.iter_document_chunks(chunk_size, streaming)):
+                n_chunks += 1
+                docnos = [document["docno"] for document in chunk]
+                if self.expanded_chunk_path(i).exists():
+                    with self.expanded_chunk_path(i).open("r", encoding="utf-8") as file:
+                        if json.load(file)["docno"] != docnos:
+                            raise RuntimeError(f"Expanded chunks in {expansion_path} do not match the loaded documents, delete the folder to rebuild them")
+                    reused += 1
+                    progress.update()
+                    continue
+
+                texts = [document["text"] for document in chunk]
+                future = executor.submit(expand_texts, texts, max_keywords, method, max_synonyms_per_keyword, synonym_table)
+                futures[future] = (i, docnos)
+
+                # Keep only a few chunks in flight so streamed documents are not all held in memory
+                if len(futures) >= 2 * workers:
+                    done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        save_chunk(*futures.pop(future), future.result())
+                        progress.update()
+
+            for future in as_completed(futures):
+                save_chunk(*futures[future], future.result())
+                progress.update()
+
+        if self.expanded_chunk_path(n_chunks).exists():
+            raise RuntimeError(f"Expanded chunks in {expansion_path} do not match the loaded documents, delete the folder to rebuild them")
+        self.expanded_chunks = n_chunks
+        print(f"Documents expanded successfully ({reused}/{n_chunks} chunks reused from disk).")
+
+    def expansion_manifest(self) -> dict:
+        # Parameters of the expanded chunks on disk, empty if the documents were never expanded
+        manifest_path = self.indexes_folder / EXPANSION_FOLDER / "manifest.json"
+        if not manifest_path.exists():
+            return {}
+        with manifest_path.open("r", encoding="utf-8") as file:
+            return json.load(file)
+
+    def expanded_chunk_path(self, i):
+        return self.indexes_folder / EXPANSION_FOLDER / f"chunk_{i:05d}.json"
+
+    def iter_expanded_documents(self, streaming=False):
+        # Documents with their "expansion", read back one chunk at a time
+        if not hasattr(self, "expanded_chunks"):
+            # Resume with the parameters of the chunks already on disk, if any
+            self.expand_documents(streaming=streaming, **self.expansion_manifest())
+
+        documents = self.iter_documents(streaming)
+        for i in range(self.expanded_chunks):
+            with self.expanded_chunk_path(i).open("r", encoding="utf-8") as file:
+                chunk = json.load(file)
+            for docno, expansion in zip(chunk["docno"], chunk["expansion"]):
+                document = next(documents)
+                if document["docno"] != docno:
+                    raise RuntimeError(f"Expanded document {docno} does not match loaded document {document['docno']}")
+                yield {"docno": docno, "text": document["text"], "expansion": expansion}
+
+    def terrier_indexer(self, index_type: str, index_path, longest_len, longest_txt, threads=INDEXING_THREADS, text_meta=True):
+        # Same configuration for a full build and for a delta segment, so the two can be searched together.
+        # text_meta=False leaves the text out of the basic index meta, it is read from the document store instead
+        if index_type == "basic":
+            return pt.IterDictIndexer(
+            str(index_path),
+            meta={"docno": longest_len, "text": longest_txt} if text_meta else {"docno": longest_len},
             text_attrs=["text"],    # which field(s) contain the text
             meta_reverse=["docno"], # enable reverse lookup on docno
             pretokenised=False,
             fields=False,
-            threads=1, 
-        )
+            threads=threads,    # >1 builds shards in parallel and merges them into one index
+            )
+        if index_type == "keywords_expanded":
+            return pt.IterDictIndexer(
+                str(index_path),
+                meta={"docno": longest_len},
+                text_attrs=["text"],    # which field(s) contain the text
+                meta_reverse=["docno"], # enable reverse lookup on docno
+                pretokenised=False,
+                fields=False,
+                threads=threads,    # >1 builds shards in parallel and merges them into one index
+            )
+        if index_type == "two_fields":
+            return pt.IterDictIndexer(
+            str(index_path),
+            meta={"docno": longest_len},
+            text_attrs=["text", "keywords"],    # which field(s) contain the text
+            meta_reverse=["docno"],             # enable reverse lookup on docno
+            pretokenised=False,
+            threads=threads,    # >1 builds shards in parallel and merges them into one index
+            fields=True,
+            properties = {'index.document.class': 'FSADocumentIndexInMemFields'} # doesn't work
+            )
+        raise ValueError("index_type must be one of ['basic', 'keywords_expanded', 'two_fields']")
 
-        index_ref = indexer.index(corpus_dataframe.to_dict(orient="records"))
-        
-        # Open the index to ensure it is valid
-        index = pt.IndexFactory.of(index_ref)
+    def terrier_documents(self, index_type: str, documents):
+        # Documents in the layout of each Terrier index, the expanded ones need their "expansion"
+        if index_type == "basic":
+            return ({"docno": document["docno"], "text": document["text"]} for document in documents)
+        if index_type == "keywords_expanded":
+            # Documents expanded with keywords and synonyms replace the original text
+            return ({"docno": document["docno"], "text": document["expansion"]} for document in documents)
+        # Create keywords field
+        return ({"docno": document["docno"], "text": document["text"], "keywords": document["expansion"]} for document in documents)
 
-        # Print a simple summary
-        print("Index location:", keywords_expanded_index_path)
-        print("Indexed documents:", index.getCollectionStatistics().getNumberOfDocuments())
-    
-    def create_two_fields_index(self):
-        if not hasattr(self.collection, "corpus_dataframe"):
-            raise RuntimeError("Documents not loaded. Call load_documents() before creating an index.")
-        longest_len = self.collection.corpus_dataframe["docno"].str.len().max()
+    def create_terrier_index(self, index_type: str, streaming=False, threads=INDEXING_THREADS, text_meta=True):
+        longest_len, longest_txt = self.corpus_lengths(streaming)
 
         # Create index or raise error if it exists
-        two_fields_index_path = self.indexes_folder / TWO_FIELDS_INDEX_NAME
-        if two_fields_index_path.exists():
-            raise RuntimeError(f"Index already exists: {two_fields_index_path}")
-        two_fields_index_path.mkdir(parents=True)
+        index_path = self.indexes_folder / INDEX_TYPES[index_type]
+        if index_path.exists():
+            raise RuntimeError(f"Index already exists: {index_path}")
+        index_path.mkdir(parents=True)
 
-        corpus_dataframe = self.collection.corpus_dataframe.copy() # Make a copy to avoid modifying the original
-        # Create keywords field
-        tqdm.pandas(desc="Creating keywords field")
-        corpus_dataframe["keywords"] = corpus_dataframe["text"].progress_apply(
-            lambda q: " ".join(
-                thesaurus_based_expansion(q, keywords_extractor(q))
-            )
-        )
-
-        # Build the indexer using the pt.IterDictIndexer
-        indexer = pt.IterDictIndexer(
-        str(two_fields_index_path),
-        meta={"docno": longest_len},
-        text_attrs=["text", "keywords"],    # which field(s) contain the text
-        meta_reverse=["docno"],             # enable reverse lookup on docno
-        pretokenised=False,
-        threads=1, 
-        fields=True,
-        properties = {'index.document.class': 'FSADocumentIndexInMemFields'} # doesn't work
-        )
-
-        index_ref = indexer.index(corpus_dataframe.to_dict(orient="records"))
+        documents = self.iter_documents(streaming) if index_type == "basic" else self.iter_expanded_documents(streaming)
+        indexer = self.terrier_indexer(index_type, index_path, longest_len, longest_txt, threads, text_meta)
+        index_ref = indexer.index(self.terrier_documents(index_type, documents))
 
         # Open the index to ensure it is valid
         index = pt.IndexFactory.of(index_ref)
 
         # Print a simple summary
-        print("Index location:", two_fields_index_path)
+        print("Index location:", index_path)
         print("Indexed documents:", index.getCollectionStatistics().getNumberOfDocuments())
 
-    def create_dense_index(self):
-        if not hasattr(self.collection, "corpus_dataframe"):
-            raise RuntimeError("Documents not loaded. Call load_documents() before creating an index.")
-        
+    def create_basic_index(self, streaming=False, threads=INDEXING_THREADS, text_meta=False):
+        # The texts go to the document store, a fixed width Terrier meta field would reserve the longest text for every document.
+        # text_meta=True also keeps them in the index, as before the document store
+        self.create_terrier_index("basic", streaming, threads, text_meta)
+        # The store of an earlier index may hold another corpus, it is rebuilt with the index
+        store_path = self.indexes_folder / DOCUMENT_STORE_NAME
+        if store_path.exists():
+            if hasattr(self, "document_store"):
+                self.document_store.close()
+                del self.document_store
+            shutil.rmtree(store_path)
+        self.create_document_store(streaming)
+
+    def create_keywords_expanded_index(self, streaming=False, threads=INDEXING_THREADS):
+        self.create_terrier_index("keywords_expanded", streaming, threads)
+
+    def create_two_fields_index(self, streaming=False, threads=INDEXING_THREADS):
+        self.create_terrier_index("two_fields", streaming, threads)
+
+    def create_document_store(self, streaming=False, block_size=DOCUMENT_STORE_BLOCK_SIZE):
+        # Compressed blocks of document texts, memory-mapped by load_document_store() for get_text style stages
+        from docstore import write_document_store
+        store_path = self.indexes_folder / DOCUMENT_STORE_NAME
+        if store_path.exists():
+            raise RuntimeError(f"Document store already exists: {store_path}")
+        store = write_document_store(store_path, self.iter_documents(streaming), block_size)
+        print("Document store location:", store_path)
+        print("Stored documents:", len(store))
+
+    def create_dense_index(self, streaming=False, checkpoint_size=DENSE_CHECKPOINT_SIZE, batch_size=32, precision=None):
+        from pyterrier_dr import FlexIndex, RetroMAE
         # Create index or raise error if it exists
         dense_index_path = self.indexes_folder / DENSE_INDEX_NAME
         if dense_index_path.exists():
             raise RuntimeError(f"Index already exists: {dense_index_path}")
-        
-        # build an indexing pipeline that first applies RetroMAE to get dense vectors, then indexes them into the FlexIndex
+
+        # Documents are encoded with RetroMAE in checkpoints of checkpoint_size documents, each one saved on its own,
+        # so an interrupted build resumes from the last finished checkpoint
+        checkpoints_path = self.indexes_folder / DENSE_CHECKPOINTS_FOLDER
+        checkpoints_path.mkdir(parents=True, exist_ok=True)
+        manifest = {"model": DENSE_MODEL_NAME, "checkpoint_size": checkpoint_size}
+        manifest_path = checkpoints_path / "manifest.json"
+        if manifest_path.exists():
+            with manifest_path.open("r", encoding="utf-8") as file:
+                saved_manifest = json.load(file)
+            if saved_manifest != manifest:
+                raise RuntimeError(f"Dense checkpoints in {checkpoints_path} were built with {saved_manifest}, delete the folder to rebuild them with {manifest}")
+        else:
+            with manifest_path.open("w", encoding="utf-8") as file:
+                json.dump(manifest, file)
+
+        model = None
+        n_checkpoints = 0
+        for i, chunk in enumerate(tqdm(self.iter_document_chunks(checkpoint_size, streaming), desc="Encoding documents", unit="checkpoint")):
+            n_checkpoints += 1
+            docnos = [document["docno"] for document in chunk]
+            vecs_path = checkpoints_path / f"checkpoint_{i:05d}.npy"
+            docnos_path = checkpoints_path / f"checkpoint_{i:05d}.json"
+            if vecs_path.exists() and docnos_path.exists():
+                with docnos_path.open("r", encoding="utf-8") as file:
+                    if json.load(file) != docnos:
+                        raise RuntimeError(f"Dense checkpoints in {checkpoints_path} do not match the loaded documents, delete the folder to rebuild them")
+                continue
+
+            if model is None:
+                model = RetroMAE.msmarco_distill(batch_size=batch_size)
+            vecs = np.asarray(model.encode_docs([document["text"] for document in chunk]), dtype=np.float32)
+
+            # The vectors are written last, a checkpoint only counts once both files are in place
+            with docnos_path.open("w", encoding="utf-8") as file:
+                json.dump(docnos, file)
+            with open(vecs_path.with_suffix(".tmp"), "wb") as file:
+                np.save(file, vecs)
+            os.replace(vecs_path.with_suffix(".tmp"), vecs_path)
+
+        def checkpointed_documents():
+            for i in range(n_checkpoints):
+                with (checkpoints_path / f"checkpoint_{i:05d}.json").open("r", encoding="utf-8") as file:
+                    docnos = json.load(file)
+                vecs = np.load(checkpoints_path / f"checkpoint_{i:05d}.npy", mmap_mode="r")
+                for docno, vec in zip(docnos, vecs):
+                    yield {"docno": docno, "doc_vec": np.asarray(vec)}
+
+        # Write the FlexIndex from the checkpoints, then drop them
         dense_index = FlexIndex(str(dense_index_path), verbose = 1)
-        model = RetroMAE.msmarco_distill()
-        offline_indexing_pipeline = model >> dense_index.indexer(mode="overwrite")
-        
-        corpus_dataframe = self.collection.corpus_dataframe.copy()
-        corpus_dataframe = corpus_dataframe.to_dict(orient="records")
-        # create the index
-        offline_indexing_pipeline.index(corpus_dataframe)
+        dense_index.indexer(mode="overwrite").index(checkpointed_documents())
+        shutil.rmtree(checkpoints_path)
+
+        if precision:
+            self.compact_dense_index(precision)
 
         # Print a simple summary
         print("Index location:", dense_index_path)
 
-    def load_basic_index(self):
-        index_path = self.indexes_folder / BASIC_INDEX_NAME
+    def compact_dense_index(self, precision="float16"):
+        # Reduced precision copy of the dense vectors (float16, or int8 with scale factors), used by load_dense_index(precision=...)
+        index_path = self.indexes_folder / DENSE_INDEX_NAME
         if not index_path.exists():
             raise RuntimeError(f"Index does not exist: {index_path}")
-        self.basic_index = pt.IndexFactory.of(str(index_path))
-    
-    def load_keywords_expanded_index(self):
-        index_path = self.indexes_folder / KEYWORDS_INDEX_NAME
+        from dense import write_compact_vectors
+        write_compact_vectors(index_path, precision)
+        print(f"Compact {precision} vectors written to:", index_path)
+
+    def load_terrier_index(self, index_name: str):
+        # Base index and its delta segments searched as one Terrier MultiIndex
+        index_path = self.indexes_folder / index_name
         if not index_path.exists():
             raise RuntimeError(f"Index does not exist: {index_path}")
-        self.keywords_expanded_index = pt.IndexFactory.of(str(index_path))
+        if index_name in self.merged:
+            self.remove_retired(index_name)
+        index = pt.IndexFactory.of(str(index_path))
+        segments = [pt.IndexFactory.of(str(segment_path)) for segment_path, _ in self.delta_segments(index_name)]
+        if not segments:
+            return index
+        statistics = index.getCollectionStatistics()
+        return pt.terrier.J.MultiIndex([index] + segments, statistics.hasPositions(), statistics.getNumberOfFields() > 0)
+
+    def load_basic_index(self):
+        self.basic_index = self.load_terrier_index(BASIC_INDEX_NAME)
+        # The texts of the basic index are read from the document store when there is one
+        if (self.indexes_folder / DOCUMENT_STORE_NAME).exists():
+            self.load_document_store()
+
+    def load_document_store(self):
+        from docstore import DocumentStore
+        store_path = self.indexes_folder / DOCUMENT_STORE_NAME
+        if not store_path.exists():
+            raise RuntimeError(f"Document store does not exist: {store_path}, create it with create_document_store()")
+        self.document_store = DocumentStore(store_path)
+
+    def text_loader(self, text_field="text") -> pt.Transformer:
+        # Adds the document text to a run: from the document store if it is loaded, otherwise from the basic index meta
+        if hasattr(self, "document_store"):
+            from docstore import DocumentText
+            return DocumentText(self.document_store, text_field)
+        if not hasattr(self, "basic_index"):
+            raise RuntimeError("The document texts are read from the document_store or the basic_index, try load_basic_index()")
+        return pt.text.get_text(self.basic_index, text_field)
+    
+    def load_keywords_expanded_index(self):
+        self.keywords_expanded_index = self.load_terrier_index(KEYWORDS_INDEX_NAME)
 
     def load_two_fields_index(self):
-        index_path = self.indexes_folder / TWO_FIELDS_INDEX_NAME
-        if not index_path.exists():
-            raise RuntimeError(f"Index does not exist: {index_path}")
-        self.two_fields_index = pt.IndexFactory.of(str(index_path))
+        self.two_fields_index = self.load_terrier_index(TWO_FIELDS_INDEX_NAME)
     
-    def load_dense_index(self):
+    def load_dense_index(self, precision=None):
+        from pyterrier_dr import FlexIndex
+        from dense import CompactFlexIndex, SegmentedFlexIndex
         index_path = self.indexes_folder / DENSE_INDEX_NAME
         if not index_path.exists():
             raise RuntimeError(f"Index does not exist: {index_path}")
-        self.dense_index = FlexIndex(str(index_path))
\ No newline at end of file
+        if DENSE_INDEX_NAME in self.merged:
+            self.remove_retired(DENSE_INDEX_NAME)
+        if precision:
+            # Memory-mapped float16/int8 vectors instead of the float32 ones
+            self.dense_index = CompactFlexIndex(str(index_path), precision)
+        else:
+            self.dense_index = FlexIndex(str(index_path))
+        deltas = [(FlexIndex(str(segment_path)), docnos) for segment_path, docnos in self.delta_segments(DENSE_INDEX_NAME)]
+        if deltas:
+            self.dense_index = SegmentedFlexIndex(self.dense_index, deltas)
+
+    def delta_folder(self, index_name: str) -> Path:
+        return self.indexes_folder / DELTA_SEGMENTS_FOLDER / index_name
+
+    def delta_manifest(self, index_name: str) -> dict:
+        # {"next": number of the next segment, "segments": [{"name", "docnos"}] in the order they were added,
+        #  "retired": folders replaced by a merge, relative to indexes_folder, deleted on the next load}
+        manifest_path = self.delta_folder(index_name) / "manifest.json"
+        if not manifest_path.exists():
+            return {"next": 1, "segments": []}
+        with manifest_path.open("r", encoding="utf-8") as file:
+            return json.load(file)
+
+    def save_delta_manifest(self, index_name: str, manifest: dict):
+        manifest_path = self.delta_folder(index_name) / "manifest.json"
+        manifest_path.parent.mkdir(parents=True, exist_ok=True)
+        with manifest_path.with_suffix(".tmp").open("w", encoding="utf-8") as file:
+            json.dump(manifest, file)
+        os.replace(manifest_path.with_suffix(".tmp"), manifest_path)
+
+    def delta_segments(self, index_name: str) -> list:
+        # (path, docnos) of every delta segment of an index
+        with self.segments_lock:
+            manifest = self.delta_manifest(index_name)
+        return [(self.delta_folder(index_name) / segment["name"], segment["docnos"]) for segment in manifest["segments"]]
+
+    def indexed_docnos(self, index_type: str, docnos: list) -> set:
+        # The docnos already in the base index or in one of its delta segments
+        index_name = INDEX_TYPES[index_type]
+        index_path = self.indexes_folder / index_name
+        if not index_path.exists():
+            raise RuntimeError(f"Index does not exist: {index_path}, create it with create_{index_name.removesuffix('.flex')}()")
+        indexed = {docno for _, segment_docnos in self.delta_segments(index_name) for docno in segment_docnos}
+        if index_type == "dense":
+            from pyterrier_dr import FlexIndex
+            docnos = set(docnos)
+            return indexed | {docno for docno in FlexIndex(str(index_path)).docnos() if docno in docnos}
+        meta = pt.IndexFactory.of(str(index_path)).getMetaIndex()
+        return indexed | {docno for docno in docnos if meta.getDocument("docno", docno) >= 0}
+
+    def add_documents(self, documents, index_types=tuple(INDEX_TYPES)):
+        # Append path: only the {docno, text} documents that are not indexed yet go into a new delta segment of each index,
+        # so the cost depends on the new documents and not on the corpus. load_*() searches the base and its deltas together.
+        if self.read_only:
+            raise RuntimeError("Indexes loaded with read_only=True cannot be extended")
+        new_documents = {}
+        for document in documents:
+            new_documents.setdefault(document["docno"], document)
+        expansions = {}
+        for index_type in index_types:
+            if index_type not in INDEX_TYPES:
+                raise ValueError(f"index_type must be one of {list(INDEX_TYPES)}")
+            index_name = INDEX_TYPES[index_type]
+            indexed = self.indexed_docnos(index_type, list(new_documents))
+            segment_documents = [document for docno, document in new_documents.items() if docno not in indexed]
+            if not segment_documents:
+                print(f"{index_name}: no new documents to index")
+                continue
+
+            with self.segments_lock:
+                manifest = self.delta_manifest(index_name)
+                segment_name = f"delta_{manifest['next']:05d}"
+                manifest["next"] += 1
+                self.save_delta_manifest(index_name, manifest)
+
+            # The segment is written under a temporary name, it only counts once it is in the manifest
+            segment_path = self.delta_folder(index_name) / segment_name
+            tmp_path = segment_path.with_name(f"{segment_name}.tmp")
+            if tmp_path.exists():
+                shutil.rmtree(tmp_path)
+            if index_type == "dense":
+                from pyterrier_dr import FlexIndex
+                model = self.query_encoder(cached=False)
+                vecs = np.asarray(model.encode_docs([document["text"] for document in segment_documents]), dtype=np.float32)
+                FlexIndex(str(tmp_path)).indexer().index({"docno": document["docno"], "doc_vec": vec} for document, vec in zip(segment_documents, vecs))
+            else:
+                if index_type != "basic":
+                    # Expanded with the same parameters as the base documents, once for both expanded indexes
+                    missing = [document for document in segment_documents if document["docno"] not in expansions]
+                    if missing:
+                        parameters = self.expansion_manifest()
+                        texts = [document["text"] for document in missing]
+                        expanded = expand_texts(texts, parameters.get("max_keywords", 3), parameters.get("method", "rake"), parameters.get("max_synonyms_per_keyword", 2), self.cache_folder / SYNONYM_TABLE_NAME)
+                        expansions.update(zip([document["docno"] for document in missing], expanded))
+                    segment_documents = [dict(document, expansion=expansions[document["docno"]]) for document in segment_documents]
+                tmp_path.mkdir(parents=True)
+                longest_len = max(len(document["docno"]) for document in segment_documents)
+                longest_txt = max(len(document["text"]) for document in segment_documents)
+                # A delta segment has the same meta fields as its base
+                base_keys = pt.IndexFactory.of(str(self.indexes_folder / index_name)).getMetaIndex().getKeys()
+                indexer = self.terrier_indexer(index_type, tmp_path, longest_len, longest_txt, threads=1, text_meta="text" in list(base_keys))
+                indexer.index(self.terrier_documents(index_type, segment_documents))
+            os.replace(tmp_path, segment_path)
+
+            with self.segments_lock:
+                manifest = self.delta_manifest(index_name)
+                manifest["segments"].append({"name": segment_name, "docnos": [document["docno"] for document in segment_documents]})
+                self.save_delta_manifest(index_name, manifest)
+            print(f"{index_name}: {len(segment_documents)} new documents indexed in {segment_path}")
+
+        # The document store is not segmented, new texts are appended to it
+        if (self.indexes_folder / DOCUMENT_STORE_NAME).exists():
+            if not hasattr(self, "document_store"):
+                self.load_document_store()
+            print(f"{DOCUMENT_STORE_NAME}: {self.document_store.append(new_documents.values())} new documents stored")
+        print("Reload the indexes to search the new documents.")
+
+    def merge_segments(self, index_type: str, background=True):
+        # Merge the delta segments of an index into its base. With background=True the merged copy is written
+        # by another process and swapped in when it is done, the loaded indexes keep working until they are reloaded.
+        # Segments added while a merge runs stay deltas until the next merge.
+        if index_type not in INDEX_TYPES:
+            raise ValueError(f"index_type must be one of {list(INDEX_TYPES)}")
+        if self.read_only:
+            raise RuntimeError("Indexes loaded with read_only=True cannot be merged")
+        if index_type in self.merges and not self.merges[index_type].done():
+            raise RuntimeError(f"A merge of the {index_type} index is already running")
+        index_name = INDEX_TYPES[index_type]
+        merged_path = self.delta_folder(index_name) / "merged"
+        if (merged_path / "merged_segments.json").exists():
+            # Finished by an earlier merge that could not swap the folders
+            with (merged_path / "merged_segments.json").open("r", encoding="utf-8") as file:
+                self.finish_merge(index_type, json.load(file))
+            return None
+        segments = [segment_path for segment_path, _ in self.delta_segments(index_name)]
+        if not segments:
+            print(f"{index_name}: no delta segments to merge")
+            return None
+
+        arguments = (index_type, str(self.indexes_folder / index_name), [str(segment_path) for segment_path in segments], str(merged_path))
+        if not background:
+            self.finish_merge(index_type, merge_index_segments(*arguments))
+            return None
+
+        def merge_done(future):
+            if future.exception() is not None:
+                print(f"Merging the {index_name} segments failed: {future.exception()!r}")
+                return
+            try:
+                self.finish_merge(index_type, future.result())
+            except OSError as error:
+                print(f"The merged {index_name} is in {merged_path} but could not replace the base ({error!r}), close the index and call merge_segments('{index_type}') again")
+
+        # Spawned so the merge gets its own JVM instead of a copy of this one
+        executor = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn"))
+        future = executor.submit(merge_index_segments, *arguments)
+        future.add_done_callback(merge_done)
+        executor.shutdown(wait=False)
+        self.merges[index_type] = future
+        print(f"Merging {len(segments)} delta segment(s) of {index_name} in the background")
+        return future
+
+    def finish_merge(self, index_type: str, merged_segments: list):
+        # Swap the merged index in place of the base and drop the segments it contains.
+        # The loaded index may still read the old base and segments (Terrier opens some structures lazily),
+        # so they are only retired here and deleted by the next load_*() of the index in this process.
+        index_name = INDEX_TYPES[index_type]
+        index_path = self.indexes_folder / index_name
+        with self.segments_lock:
+            manifest = self.delta_manifest(index_name)
+            old_path = index_path.with_name(f"{index_path.name}.old_{manifest['next']:05d}")
+            if index_path.exists():
+                # Left by a swap of this merge that was interrupted before the base was moved back in
+                if old_path.exists():
+                    shutil.rmtree(old_path)
+                os.replace(index_path, old_path)
+            os.replace(self.delta_folder(index_name) / "merged", index_path)
+            retired = [old_path] + [self.delta_folder(index_name) / segment_name for segment_name in merged_segments]
+            manifest["retired"] = manifest.get("retired", []) + [str(path.relative_to(self.indexes_folder)) for path in retired]
+            manifest["segments"] = [segment for segment in manifest["segments"] if segment["name"] not in merged_segments]
+            self.save_delta_manifest(index_name, manifest)
+        self.merged.add(index_name)
+        (index_path / "merged_segments.json").unlink(missing_ok=True)
+        print(f"{len(merged_segments)} delta segment(s) merged into {index_path}, reload the index to use it")
+
+    def remove_retired(self, index_name: str):
+        # Delete the base and segments replaced by earlier merges. Called when the process that ran the merge
+        # reloads the index, other processes (e.g. the experiment workers) may still have them open
+        with self.segments_lock:
+            manifest = self.delta_manifest(index_name)
+            if not manifest.get("retired"):
+                return
+            for path in manifest["retired"]:
+                shutil.rmtree(self.indexes_folder / path, ignore_errors=True)
+            manifest["retired"] = []
+            self.save_delta_manifest(index_name, manifest)
+
+def merge_index_segments(index_type: str, index_path: str, segment_paths: list, merged_path: str) -> list:
+    # Write the base index and its delta segments as one index in merged_path, returns the merged segment names.
+    # Module level so it can run in a process pool.
+    merged_path = Path(merged_path)
+    if merged_path.exists():
+        shutil.rmtree(merged_path)
+    if index_type == "dense":
+        from pyterrier_dr import FlexIndex
+        from dense import COMPACT_FILES, write_compact_vectors
+        def vectors():
+            for path in [index_path] + segment_paths:
+                yield from FlexIndex(path).get_corpus_iter(verbose=False)
+        FlexIndex(str(merged_path)).indexer().index(vectors())
+        # Rebuild the compact vectors the base had, the FAISS structures are rebuilt on first use
+        for precision, files in COMPACT_FILES.items():
+            if (Path(index_path) / files[0]).exists():
+                write_compact_vectors(merged_path, precision)
+    else:
+        if not pt.java.started():
+            pt.java.init()
+        # Terrier merges two indexes at a time, the segments are folded into the base one by one
+        current = index_path
+        for i, segment_path in enumerate(segment_paths):
+            target = merged_path if i == len(segment_paths) - 1 else merged_path.with_name(f"merged.{i}")
+            target.mkdir(parents=True)
+            first = pt.terrier.J.IndexOnDisk.createIndex(current, "data")
+            second = pt.terrier.J.IndexOnDisk.createIndex(segment_path, "data")
+            merged = pt.terrier.J.IndexOnDisk.createNewIndex(str(target), "data")
+            pt.terrier.J.StructureMerger(first, second, merged).mergeStructures()
+            for index in (first, second, merged):
+                index.close()
+            if current != index_path:
+                shutil.rmtree(current)
+            current = str(target)
+    merged_segments = [Path(segment_path).name for segment_path in segment_paths]
+    # Written last, marks the merged index as complete
+    with (merged_path / "merged_segments.json").open("w", encoding="utf-8") as file:
+        json.dump(merged_segments, file)
+    return merged_segments
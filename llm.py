@@ -1,34 +1,111 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+import httpx
+import pandas as pd
 import pyterrier as pt
-from openai import OpenAI
-from ollama import Client as OllamaClient
-from ollama import chat as ollama_chat
-from pyterrier_t5 import MonoT5ReRanker
-from transformers import T5Tokenizer # useful chat on tokenization, finetuning and Mono T5: https://chatgpt.com/share/696468e8-c33c-8009-88ba-5843b8a46d21
 from collection import BenchmarkCollection
 from indexes import BenchmarkIndex
 from functions import TokenizerWrapper
+from caches import DiskCache
+from pipelines import cached_monot5, HybridRetriever, PipelineProfile, instrument
+from constants import LMSTUDIO_BASE_URL, OLLAMA_CLOUD_HOST, LLM_MAX_CONNECTIONS, LLM_TIMEOUT, LLM_CONCURRENCY, MONOT5_CACHE_NAME, HYBRID_BRANCH_DEPTH
+
+SYSTEM_PROMPT = (
+    "You are a helpful assistant. "
+    "Answer reading the context ONLY if it is relevant."
+    "IF THE TOPIC OF DISCUSSION IS NOT IN THE CONTEXT REPLY 'I DO NOT KNOW' OTHERWISE MENTION THE RELEVANT THINGS IN THE CONTEXT"
+)
+
+def run_coroutine(make_coroutine):
+    # asyncio.run() from synchronous code. Jupyter already runs an event loop in this thread,
+    # and asyncio.run() refuses to start another one there, so the coroutine gets its own thread
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(make_coroutine())
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(lambda: asyncio.run(make_coroutine())).result()
 
 class llm():
-    def __init__(self, collection:BenchmarkCollection, indexes:BenchmarkIndex):
+    def __init__(self, collection:BenchmarkCollection, indexes:BenchmarkIndex, warmup_query:str|None=None,
+                 lmstudio_url=LMSTUDIO_BASE_URL, ollama_host=None, max_connections=LLM_MAX_CONNECTIONS,
+                 first_stage="bm25", candidates=100, fusion="rrf", monot5_cpu_mode=False, monot5_options=None,
+                 profile=False):
         self.collection = collection
         self.indexes = indexes
 
-        self.create_tokenizer()
+        # first_stage="hybrid" fuses BM25 and dense retrieval, candidates is how many documents reach MonoT5
+        self.first_stage = first_stage
+        self.candidates = candidates
+        self.fusion = fusion
+        # monot5_cpu_mode=True reranks with the CPU mode of pipelines.load_monot5, monot5_options are passed to it
+        self.monot5_cpu_mode = monot5_cpu_mode
+        self.monot5_options = monot5_options or {}
+        # profile=True times every stage of the retrieval pipeline, see self.profile.report()
+        self.profile = PipelineProfile() if profile else None
+
+        # Endpoints can point to any compatible server, e.g. a local mock server.
+        # ollama_host=None keeps ollama's default (OLLAMA_HOST or localhost:11434)
+        self.lmstudio_url = lmstudio_url
+        self.ollama_host = ollama_host
+        self.max_connections = max_connections
+        self.clients = {}
+        self.async_clients = {}
+
+        # The tokenizer, MonoT5 and the JVM are only loaded by the first question (or the warm up query),
+        # so creating the llm stays cheap when it is not used
+        if warmup_query:
+            self.pipeline().search(warmup_query)
 
     def create_tokenizer(self):
+        from transformers import T5Tokenizer # useful chat on tokenization, finetuning and Mono T5: https://chatgpt.com/share/696468e8-c33c-8009-88ba-5843b8a46d21
         base_tok = T5Tokenizer.from_pretrained("t5-base")
         self.tokenizer = TokenizerWrapper(base_tok)
 
-    def retriever(self, query:str, document_context_number=3):
+    def pipeline(self):
+        if not hasattr(self, "mono_pipeline"):
+            self.create_pipeline()
+        return self.mono_pipeline
+
+    def create_pipeline(self):
+        # Built once and reused by every question, so MonoT5 is loaded a single time
+        first_stage = self.first_stage_retriever(self.first_stage, self.candidates, self.fusion)
+        self.load_reranker()
+        self.mono_pipeline = instrument(self.rerank_pipeline(first_stage), self.profile, "rag")
+
+    def load_reranker(self):
+        # MonoT5 with the on-disk score cache
+        self.monoT5 = cached_monot5(DiskCache(self.indexes.cache_folder / MONOT5_CACHE_NAME), batch_size = 16,
+                                    cpu_mode = self.monot5_cpu_mode, **self.monot5_options)
+
+    def first_stage_retriever(self, first_stage="bm25", candidates=100, fusion="rrf", cached=True):
+        # cached=False skips the run and query embedding caches, e.g. to measure retrieval latency
         if not hasattr(self.indexes, "basic_index"):
             raise RuntimeError("The retriever uses the basic_index, make sure it is loaded: try load_basic_index()")
-        
-        bm25 = pt.terrier.Retriever(self.indexes.basic_index, wmodel="BM25")
-        monoT5 = MonoT5ReRanker(batch_size = 16)
 
-        mono_pipeline = (
-        (bm25 % 100)                              
-        >> pt.text.get_text(self.indexes.basic_index, "text")
+        if first_stage == "bm25":
+            bm25 = self.indexes.retriever("basic_index", wmodel="BM25", cached=cached)
+            return bm25 % candidates
+        if first_stage == "hybrid":
+            if not hasattr(self.indexes, "dense_index"):
+                raise RuntimeError("The hybrid retriever also uses the dense_index, make sure it is loaded: try load_dense_index()")
+            bm25 = self.indexes.retriever("basic_index", wmodel="BM25", num_results=HYBRID_BRANCH_DEPTH, cached=cached)
+            dense = self.indexes.query_encoder(cached) >> self.indexes.dense_retriever(num_results=HYBRID_BRANCH_DEPTH)
+            return HybridRetriever(bm25, dense, fusion=fusion, num_results=candidates)
+        raise ValueError("first_stage must be 'bm25' or 'hybrid'")
+
+    def rerank_pipeline(self, first_stage: pt.Transformer, monoT5: pt.Transformer | None = None):
+        if monoT5 is None:
+            # Loaded here too, rerank_pipeline can be used before the first question built the pipeline
+            if not hasattr(self, "monoT5"):
+                self.load_reranker()
+            monoT5 = self.monoT5
+        if not hasattr(self, "tokenizer"):
+            self.create_tokenizer()
+        return (
+        first_stage
+        >> self.indexes.text_loader()
         >> pt.text.sliding(                   
             length=256,
             stride=128,
@@ -39,8 +116,7 @@ class llm():
         >> pt.text.max_passage()            
         )
 
-        results = mono_pipeline.search(query)
-
+    def build_context(self, results: pd.DataFrame, document_context_number=3):
         context = ""
         for i in range(document_context_number):
             context += (
@@ -49,39 +125,104 @@ class llm():
             )
 
         return context
+
+    def retriever(self, query:str, document_context_number=3):
+        results = self.pipeline().search(query)
+        return self.build_context(results, document_context_number)
+
+    def batch_retriever(self, queries:list[str], document_context_number=3) -> list[str]:
+        # All queries go through BM25 and MonoT5 in a single transform, contexts come back in order
+        topics = pd.DataFrame({"qid": [str(i) for i in range(len(queries))], "query": queries})
+        results = self.pipeline().transform(topics)
+
+        contexts = []
+        for qid in topics["qid"]:
+            query_results = results[results["qid"] == qid].sort_values("rank")
+            contexts.append(self.build_context(query_results, document_context_number))
+        return contexts
     
-    def answer_openai(self, prompt: str, context: str, model: str, server: str = "local", api_key: str | None = None):
-        if server == "openai":
-            if not api_key:
-                raise ValueError("OpenAI API key is required for online usage")
-            client = OpenAI(api_key=api_key)
+    def get_client(self, backend: str, server: str, api_key: str | None = None, asynchronous: bool = False):
+        # Clients are long-lived and keyed by endpoint and server, so their connection pool
+        # (and its keep-alive connections) is shared by every answer.
+        # Async clients belong to the event loop of the run they were created in, they are kept
+        # in async_clients only until answer_many_timed_async closes them at the end of the run.
+        clients = self.async_clients if asynchronous else self.clients
+        key = (backend, server, api_key)
+        if key in clients:
+            return clients[key]
 
-        elif server == "local":
-            client = OpenAI(
+        limits = httpx.Limits(max_connections=self.max_connections, max_keepalive_connections=self.max_connections)
+        if backend == "openai":
+            if server == "openai":
+                if not api_key:
+                    raise ValueError("OpenAI API key is required for online usage")
+                client_kwargs = {"api_key": api_key}
+            elif server == "local":
                 # Note: ollama also supports Openai endpoint
                 # you can run local models through ollama
                 # base_url = "http://localhost:11434/v1"
-                base_url="http://localhost:1234/v1", # perfect if using LM-studio server
-                api_key="not-needed"
-            )
+                client_kwargs = {"base_url": self.lmstudio_url, "api_key": "not-needed"} # perfect if using LM-studio server
+            else:
+                raise ValueError("server must be 'local' or 'openai'")
+
+            from openai import OpenAI, AsyncOpenAI
+            if asynchronous:
+                client = AsyncOpenAI(http_client=httpx.AsyncClient(limits=limits, timeout=LLM_TIMEOUT), **client_kwargs)
+            else:
+                client = OpenAI(http_client=httpx.Client(limits=limits, timeout=LLM_TIMEOUT), **client_kwargs)
+
+        elif backend == "ollama":
+            if server == "cloud":
+                if not api_key:
+                    raise ValueError("Ollama API key is required for cloud usage")
+                client_kwargs = {"host": OLLAMA_CLOUD_HOST, "headers": {"Authorization": "Bearer " + api_key}}
+            elif server == "local":
+                client_kwargs = {"host": self.ollama_host}
+            else:
+                raise ValueError("server must be 'local' or 'cloud'")
+
+            from ollama import Client as OllamaClient
+            from ollama import AsyncClient as OllamaAsyncClient
+            client_class = OllamaAsyncClient if asynchronous else OllamaClient
+            client = client_class(limits=limits, timeout=LLM_TIMEOUT, **client_kwargs)
 
         else:
-            raise ValueError("server must be 'local' or 'openai'")
+            raise ValueError("backend must be 'openai' or 'ollama'")
+
+        clients[key] = client
+        return client
+
+    def openai_messages(self, prompt: str, context: str):
+        return [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "tool", "content": context},
+            {"role": "user", "content": prompt},
+        ]
+
+    def ollama_messages(self, prompt: str, context: str):
+        return [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": f"{context}\n\n{prompt}"},
+        ]
+
+    def answer_openai(self, prompt: str, context: str, model: str, server: str = "local", api_key: str | None = None):
+        client = self.get_client("openai", server, api_key)
 
         response = client.chat.completions.create(
             model=model,
-            messages=[
-                {
-                    "role": "system",
-                    "content": (
-                        "You are a helpful assistant. "
-                        "Answer reading the context ONLY if it is relevant."
-                        "IF THE TOPIC OF DISCUSSION IS NOT IN THE CONTEXT REPLY 'I DO NOT KNOW' OTHERWISE MENTION THE RELEVANT THINGS IN THE CONTEXT"
-                    ),
-                },
-                {"role": "tool", "content": context},
-                {"role": "user", "content": prompt},
-            ],
+            messages=self.openai_messages(prompt, context),
+            temperature=0.7,
+            max_completion_tokens=256,
+        )
+
+        return response.choices[0].message.content
+
+    async def answer_openai_async(self, prompt: str, context: str, model: str, server: str = "local", api_key: str | None = None):
+        client = self.get_client("openai", server, api_key, asynchronous=True)
+
+        response = await client.chat.completions.create(
+            model=model,
+            messages=self.openai_messages(prompt, context),
             temperature=0.7,
             max_completion_tokens=256,
         )
@@ -89,39 +230,102 @@ class llm():
         return response.choices[0].message.content
     
     def answer_ollama(self, prompt: str, context: str, model: str, server: str = "local", api_key: str | None = None):
-        messages = [
-            {
-                "role": "system",
-                "content": (
-                    "You are a helpful assistant. "
-                    "Answer reading the context ONLY if it is relevant."
-                    "IF THE TOPIC OF DISCUSSION IS NOT IN THE CONTEXT REPLY 'I DO NOT KNOW' OTHERWISE MENTION THE RELEVANT THINGS IN THE CONTEXT"
-                ),
-            },
-            {"role": "user", "content": f"{context}\n\n{prompt}"},
-        ]
+        client = self.get_client("ollama", server, api_key)
+        messages = self.ollama_messages(prompt, context)
 
         if server == "cloud":
-            if not api_key:
-                raise ValueError("Ollama API key is required for cloud usage")
+            output = ""
+            for part in client.chat(model, messages=messages, stream=True):
+                output += part["message"]["content"]
+            return output
 
-            client = OllamaClient(
-                host="https://ollama.com",
-                headers={"Authorization": "Bearer " + api_key},
-            )
+        response = client.chat(model=model, messages=messages)
+        return response["message"]["content"]
+
+    async def answer_ollama_async(self, prompt: str, context: str, model: str, server: str = "local", api_key: str | None = None):
+        client = self.get_client("ollama", server, api_key, asynchronous=True)
+        messages = self.ollama_messages(prompt, context)
 
+        if server == "cloud":
             output = ""
-            for part in client.chat(model, messages=messages, stream=True):
+            async for part in await client.chat(model, messages=messages, stream=True):
                 output += part["message"]["content"]
             return output
 
-        elif server == "local":
-            response = ollama_chat(model=model, messages=messages)
-            return response["message"]["content"]
+        response = await client.chat(model=model, messages=messages)
+        return response["message"]["content"]
 
+    async def answer_many_timed_async(self, prompts: list[str], contexts: list[str], model: str, backend: str = "ollama", server: str = "local",
+                                      api_key: str | None = None, concurrency: int | None = None):
+        # Generate the answers concurrently, in the same order as the prompts, each one timed on its own.
+        # concurrency limits how many requests are in flight, None sends them all at once.
+        if backend == "openai":
+            answer = self.answer_openai_async
+        elif backend == "ollama":
+            answer = self.answer_ollama_async
         else:
-            raise ValueError("server must be 'local' or 'cloud'")
-        
+            raise ValueError("backend must be 'openai' or 'ollama'")
+
+        semaphore = asyncio.Semaphore(concurrency or len(prompts) or 1)
+
+        async def timed_answer(prompt, context):
+            async with semaphore:
+                start = time.perf_counter()
+                output = await answer(prompt=prompt, context=context, model=model, server=server, api_key=api_key)
+                return output, time.perf_counter() - start
+
+        try:
+            return await asyncio.gather(*[timed_answer(prompt, context) for prompt, context in zip(prompts, contexts)])
+        finally:
+            await self.close_async_clients()
+
+    async def close_async_clients(self):
+        # Close the connection pools of the async clients before their event loop ends
+        clients, self.async_clients = self.async_clients, {}
+        for client in clients.values():
+            await client.close()
+
+    async def answer_many_async(self, prompts: list[str], contexts: list[str], model: str, backend: str = "ollama", server: str = "local",
+                                api_key: str | None = None, concurrency: int | None = None):
+        answers = await self.answer_many_timed_async(prompts, contexts, model, backend, server, api_key, concurrency)
+        return [output for output, _ in answers]
+
+    def answer_queries(self, questions:list[str], endpoint="ollama", server="offline", model="gemma3:4b", api_key:str|None=None,
+                       concurrency=LLM_CONCURRENCY, document_context_number=3) -> list[dict]:
+        if endpoint == "lmstudio":
+            if server != "offline":
+                raise ValueError("Endpoint lmstudio only supports offline server")
+            backend, server_mode = "openai", "local"
+        elif endpoint == "ollama":
+            backend, server_mode = "ollama", "local" if server == "offline" else "cloud"
+        else:
+            raise ValueError("Endpoint must be 'lmstudio' or 'ollama'")
+        if not questions:
+            return []
+
+        start = time.perf_counter()
+        contexts = self.batch_retriever(questions, document_context_number)
+        retrieval_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        answers = run_coroutine(lambda: self.answer_many_timed_async(questions, contexts, model, backend, server_mode, api_key, concurrency))
+        generation_time = time.perf_counter() - start
+
+        print(f"Answered {len(questions)} questions: retrieval {retrieval_time:.2f}s, generation {generation_time:.2f}s, "
+              f"{len(questions) / (retrieval_time + generation_time):.2f} questions/s")
+
+        # Retrieval runs as one batch, so its time is shared equally between the questions
+        return [
+            {
+                "question": question,
+                "answer": answer,
+                "context": context,
+                "retrieval_seconds": retrieval_time / len(questions),
+                "generation_seconds": generation_seconds,
+            }
+            for question, context, (answer, generation_seconds) in zip(questions, contexts, answers)
+        ]
+
     def answer_query(self, question:str):
         """
         !!! possible implementation for more flexibility
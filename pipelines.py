@@ -0,0 +1,400 @@
+import hashlib
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+import pyterrier as pt
+from caches import DiskCache, make_key
+from constants import MONOT5_MODEL, RRF_K
+
+class CachedRetriever(pt.Transformer):
+    # First stage Terrier retrieval with the run of every query kept on disk.
+    # Runs are keyed by index build, weighting model, controls and query text, and a run
+    # cached with more results also answers any shallower cutoff (e.g. bm25 % 100).
+    def __init__(self, index, index_name: str, cache: DiskCache, build_key, wmodel="BM25", controls=None, num_results=1000):
+        self.index_name = index_name
+        self.cache = cache
+        self.wmodel = wmodel
+        self.controls = controls or {}
+        self.num_results = num_results
+        self.retriever = pt.terrier.Retriever(index, wmodel=wmodel, controls=self.controls, num_results=num_results)
+        # build_key (the files of the index, see BenchmarkIndex.build_key) changes whenever the index is rebuilt,
+        # so stale runs and their docids are never reused
+        self.index_key = (index_name, build_key)
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return f"CachedRetriever({self.index_name}, {self.wmodel}, {self.controls})"
+
+    def query_key(self, query: str) -> str:
+        return make_key(self.index_key, self.wmodel, self.controls, query)
+
+    def transform(self, topics: pd.DataFrame) -> pd.DataFrame:
+        # Re-ranking an existing run is not a first stage, leave it to Terrier
+        if "docno" in topics.columns:
+            return self.retriever.transform(topics)
+
+        keys = [self.query_key(query) for query in topics["query"]]
+        runs = {}
+        for key, (depth, run) in self.cache.get_many(keys).items():
+            # A shorter run than its depth means the query has no more matching documents
+            if depth >= self.num_results or len(run) < depth:
+                runs[key] = run
+
+        missing = topics[[key not in runs for key in keys]].drop_duplicates("query")
+        self.hits += len(topics) - len(missing)
+        self.misses += len(missing)
+
+        if len(missing):
+            results = self.retriever.transform(missing[["qid", "query"]])
+            results_by_qid = dict(tuple(results.groupby("qid")))
+            new_runs = {}
+            for qid, query in zip(missing["qid"], missing["query"]):
+                run = results_by_qid.get(qid, results.iloc[0:0])
+                run = run.sort_values("rank")[["docid", "docno", "score", "rank"]].reset_index(drop=True)
+                new_runs[self.query_key(query)] = (self.num_results, run)
+            self.cache.put_many(new_runs)
+            runs.update({key: run for key, (_, run) in new_runs.items()})
+
+        frames = []
+        for (_, topic), key in zip(topics.iterrows(), keys):
+            frame = runs[key].head(self.num_results).copy()
+            for column in topics.columns:
+                frame[column] = topic[column]
+            frames.append(frame)
+
+        if not frames:
+            return pd.DataFrame(columns=list(topics.columns) + ["docid", "docno", "score", "rank"])
+        results = pd.concat(frames, ignore_index=True)
+        return results[list(topics.columns) + ["docid", "docno", "score", "rank"]]
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+class CachedReRanker(pt.Transformer):
+    # Cross-encoder scores kept on disk, keyed by model name, query text and a hash of the passage.
+    # Only (query, passage) pairs never scored before are sent to the wrapped reranker.
+    def __init__(self, reranker: pt.Transformer, model_name: str, cache: DiskCache, text_field="text"):
+        self.reranker = reranker
+        self.model_name = model_name
+        self.cache = cache
+        self.text_field = text_field
+        self.pairs = 0
+        self.scored = 0
+
+    def __repr__(self):
+        return f"CachedReRanker({self.model_name})"
+
+    def pair_key(self, query: str, text: str) -> str:
+        return make_key(self.model_name, query, hashlib.sha1(text.encode("utf-8")).hexdigest())
+
+    def transform(self, results: pd.DataFrame) -> pd.DataFrame:
+        if not len(results):
+            return self.reranker.transform(results)
+
+        keys = [self.pair_key(query, text) for query, text in zip(results["query"], results[self.text_field])]
+        scores = self.cache.get_many(keys)
+
+        # Identical pairs inside the same batch are scored once
+        keys_series = pd.Series(keys)
+        missing = (~keys_series.isin(list(scores)) & ~keys_series.duplicated()).to_numpy()
+        to_score = results[missing]
+        self.pairs += len(results)
+        self.scored += len(to_score)
+
+        if len(to_score):
+            scored = self.reranker.transform(to_score)
+            new_scores = {
+                self.pair_key(query, text): score
+                for query, text, score in zip(scored["query"], scored[self.text_field], scored["score"])
+            }
+            self.cache.put_many(new_scores)
+            scores.update(new_scores)
+
+        reranked = results.copy()
+        reranked["score"] = [scores[key] for key in keys]
+        return pt.model.add_ranks(reranked)
+
+    def stats(self) -> dict:
+        return {
+            "pairs": self.pairs,
+            "scored": self.scored,
+            "avoided": self.pairs - self.scored,
+            "avoided_rate": (self.pairs - self.scored) / self.pairs if self.pairs else 0.0,
+        }
+
+class BucketedMonoT5(pt.Transformer):
+    # Scores with the model and tokenizer of a loaded MonoT5ReRanker, but the passages are sorted by token length
+    # and batched with similar lengths, so little time goes into padding. Scores come back in input order.
+    def __init__(self, monoT5: pt.Transformer, model_name: str):
+        self.monoT5 = monoT5
+        self.model_name = model_name
+        self.batch_size = monoT5.batch_size
+        self.text_field = monoT5.text_field
+
+    def __repr__(self):
+        return f"BucketedMonoT5({self.model_name})"
+
+    def transform(self, run: pd.DataFrame) -> pd.DataFrame:
+        import torch
+        tokenizer, model = self.monoT5.tokenizer, self.monoT5.model
+        # Batches go to the device of the wrapped reranker (the GPU one when it has it)
+        device = getattr(self.monoT5, "device", None) or next(model.parameters()).device
+        prompt = tokenizer.encode("Relevant:")
+        max_length = model.config.n_positions - len(prompt)
+
+        # End of sequence token dropped and the prompt appended after the (truncated) passage, as MonoT5ReRanker does
+        encoded = tokenizer([f"Query: {q} Document: {d}" for q, d in zip(run["query"], run[self.text_field])])["input_ids"]
+        encoded = [ids[:-1][:max_length] + prompt for ids in encoded]
+        order = np.argsort([len(ids) for ids in encoded], kind="stable")
+
+        scores = np.zeros(len(encoded), dtype=np.float32)
+        for start in range(0, len(order), self.batch_size):
+            batch = order[start:start + self.batch_size]
+            width = max(len(encoded[i]) for i in batch)
+            input_ids = torch.full((len(batch), width), tokenizer.pad_token_id, dtype=torch.long)
+            attention_mask = torch.zeros((len(batch), width), dtype=torch.long)
+            for row, i in enumerate(batch):
+                input_ids[row, :len(encoded[i])] = torch.tensor(encoded[i])
+                attention_mask[row, :len(encoded[i])] = 1
+            decoder_input_ids = torch.full((len(batch), 1), model.config.decoder_start_token_id, dtype=torch.long)
+            with torch.inference_mode():
+                logits = model(input_ids=input_ids.to(device), attention_mask=attention_mask.to(device), decoder_input_ids=decoder_input_ids.to(device)).logits
+            logits = logits[:, 0, (self.monoT5.REL, self.monoT5.NREL)]
+            scores[batch] = torch.log_softmax(logits, dim=1)[:, 0].cpu().numpy()
+
+        run = run.drop(columns=["score", "rank"], errors="ignore").assign(score=scores)
+        return pt.model.add_ranks(run)
+
+def load_monot5(batch_size=16, cpu_mode=False, quantize=True, intra_op_threads=None, inter_op_threads=None) -> pt.Transformer:
+    # cpu_mode=True: length bucketed batches, dynamic int8 quantization of the linear layers (quantize=True)
+    # and torch thread pools sized by intra_op_threads / inter_op_threads (None keeps torch's defaults)
+    from pyterrier_t5 import MonoT5ReRanker
+    if cpu_mode:
+        import torch
+        if intra_op_threads:
+            torch.set_num_threads(intra_op_threads)
+        if inter_op_threads:
+            # Can only be set before torch runs anything in parallel
+            try:
+                torch.set_num_interop_threads(inter_op_threads)
+            except RuntimeError:
+                print("Inter-op threads already in use, keeping", torch.get_num_interop_threads())
+
+    monoT5 = MonoT5ReRanker(model=MONOT5_MODEL, batch_size=batch_size)
+    if not cpu_mode:
+        return monoT5
+
+    model_name = MONOT5_MODEL + ":bucketed"
+    if quantize:
+        monoT5.model = torch.ao.quantization.quantize_dynamic(monoT5.model, {torch.nn.Linear}, dtype=torch.qint8)
+        model_name += ":int8"
+    return BucketedMonoT5(monoT5, model_name)
+
+def cached_monot5(cache: DiskCache, batch_size=16, cpu_mode=False, **cpu_options) -> CachedReRanker:
+    monoT5 = load_monot5(batch_size, cpu_mode, **cpu_options)
+    # The CPU mode scores are cached under their own model name, apart from the float32 ones
+    return CachedReRanker(monoT5, monoT5.model_name, cache)
+
+class ScoreRatioFilter(pt.Transformer):
+    # Keeps the documents scoring at least ratio * the best score of their query,
+    # a cheap way to stop weak first stage candidates before the cross-encoder
+    def __init__(self, ratio: float):
+        self.ratio = ratio
+
+    def __repr__(self):
+        return f"ScoreRatioFilter({self.ratio})"
+
+    def transform(self, results: pd.DataFrame) -> pd.DataFrame:
+        best = results.groupby("qid")["score"].transform("max")
+        return results[results["score"] >= self.ratio * best]
+
+class FirstPassages(pt.Transformer):
+    # Keeps the first max_passages sliding windows of every document (docnos look like "docno%p0")
+    def __init__(self, max_passages: int):
+        self.max_passages = max_passages
+
+    def __repr__(self):
+        return f"FirstPassages({self.max_passages})"
+
+    def transform(self, results: pd.DataFrame) -> pd.DataFrame:
+        passage = results["docno"].str.rsplit("%p", n=1).str[-1].astype(int)
+        return results[(passage < self.max_passages).to_numpy()]
+
+class CachedQueryEncoder(pt.Transformer):
+    # Adds query_vec to the input like the bi-encoder does, with the embedding of every query
+    # kept in memory and on disk, keyed by model and query text
+    def __init__(self, model: pt.Transformer, model_name: str, cache: DiskCache):
+        self.model = model
+        self.model_name = model_name
+        self.cache = cache
+        self.embeddings = {}
+        self.encoded = 0
+        self.lookups = 0
+
+    def __repr__(self):
+        return f"CachedQueryEncoder({self.model_name})"
+
+    def transform(self, topics: pd.DataFrame) -> pd.DataFrame:
+        queries = list(dict.fromkeys(topics["query"]))
+        self.lookups += len(queries)
+
+        missing = [query for query in queries if query not in self.embeddings]
+        if missing:
+            keys = {query: make_key(self.model_name, query) for query in missing}
+            stored = self.cache.get_many(keys.values())
+            for query, key in keys.items():
+                if key in stored:
+                    self.embeddings[query] = stored[key]
+
+            to_encode = [query for query in missing if query not in self.embeddings]
+            if to_encode:
+                vectors = np.asarray(self.model.encode_queries(to_encode), dtype=np.float32)
+                self.encoded += len(to_encode)
+                new_embeddings = dict(zip(to_encode, vectors))
+                self.cache.put_many({keys[query]: vector for query, vector in new_embeddings.items()})
+                self.embeddings.update(new_embeddings)
+
+        encoded_topics = topics.copy()
+        encoded_topics["query_vec"] = [self.embeddings[query] for query in topics["query"]]
+        return encoded_topics
+
+    def stats(self) -> dict:
+        return {
+            "queries": self.lookups,
+            "encoded": self.encoded,
+            "reused": self.lookups - self.encoded,
+        }
+
+class HybridRetriever(pt.Transformer):
+    # Sparse and dense first stages run at the same time, their runs merged into one candidate list.
+    # fusion="rrf" sums 1 / (rrf_k + rank) over the two runs, fusion="weighted" sums the per-query
+    # min-max normalised scores weighted by sparse_weight and 1 - sparse_weight.
+    def __init__(self, sparse: pt.Transformer, dense: pt.Transformer, fusion="rrf", num_results=100, rrf_k=RRF_K, sparse_weight=0.5):
+        if fusion not in ["rrf", "weighted"]:
+            raise ValueError("fusion must be 'rrf' or 'weighted'")
+        self.sparse = sparse
+        self.dense = dense
+        self.fusion = fusion
+        self.num_results = num_results
+        self.rrf_k = rrf_k
+        self.sparse_weight = sparse_weight
+        self.sparse_seconds = 0.0
+        self.dense_seconds = 0.0
+        self.total_seconds = 0.0
+
+    def __repr__(self):
+        return f"HybridRetriever({self.sparse}, {self.dense}, {self.fusion}, {self.num_results})"
+
+    def timed_transform(self, transformer, topics):
+        start = time.perf_counter()
+        results = transformer.transform(topics)
+        return results, time.perf_counter() - start
+
+    def transform(self, topics: pd.DataFrame) -> pd.DataFrame:
+        start = time.perf_counter()
+        # The dense branch (query encoder and vector scan, both release the GIL) goes to a worker thread,
+        # Terrier stays on the calling thread the JVM is attached to
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            dense_future = executor.submit(self.timed_transform, self.dense, topics)
+            sparse_results, sparse_seconds = self.timed_transform(self.sparse, topics)
+            dense_results, dense_seconds = dense_future.result()
+        self.sparse_seconds += sparse_seconds
+        self.dense_seconds += dense_seconds
+
+        fused = self.fuse([(sparse_results, self.sparse_weight), (dense_results, 1 - self.sparse_weight)])
+        # Docids of the two indexes do not match, later stages look documents up by docno
+        topic_columns = [column for column in topics.columns if column not in ["query_vec", "docid", "docno", "score", "rank"]]
+        fused = fused.merge(topics[topic_columns].drop_duplicates("qid"), on="qid")
+        fused = pt.model.add_ranks(fused)
+        fused = fused[fused["rank"] < self.num_results].sort_values(["qid", "rank"]).reset_index(drop=True)
+        self.total_seconds += time.perf_counter() - start
+        return fused[topic_columns + ["docno", "score", "rank"]]
+
+    def fuse(self, runs) -> pd.DataFrame:
+        contributions = []
+        for results, weight in runs:
+            results = results[["qid", "docno", "score", "rank"]]
+            if self.fusion == "rrf":
+                # pyterrier ranks start at 0, rrf ranks at 1
+                score = 1 / (self.rrf_k + results["rank"] + 1)
+            else:
+                scores = results.groupby("qid")["score"]
+                low = scores.transform("min")
+                spread = (scores.transform("max") - low).replace(0, 1)
+                score = weight * (results["score"] - low) / spread
+            contributions.append(pd.DataFrame({"qid": results["qid"], "docno": results["docno"], "score": score}))
+        return pd.concat(contributions, ignore_index=True).groupby(["qid", "docno"], as_index=False)["score"].sum()
+
+    def stats(self) -> dict:
+        # Time spent in each branch against wall time, the difference is what running them together saves
+        return {
+            "sparse_seconds": self.sparse_seconds,
+            "dense_seconds": self.dense_seconds,
+            "total_seconds": self.total_seconds,
+            "overlap_seconds": self.sparse_seconds + self.dense_seconds - self.total_seconds,
+        }
+
+class PipelineProfile():
+    # Wall time and row counts of every instrumented stage, summed over all the calls
+    def __init__(self):
+        self.stages = {}
+
+    def record(self, stage: str, seconds: float, rows_in: int, rows_out: int):
+        stats = self.stages.setdefault(stage, {"calls": 0, "seconds": 0.0, "rows_in": 0, "rows_out": 0})
+        stats["calls"] += 1
+        stats["seconds"] += seconds
+        stats["rows_in"] += rows_in
+        stats["rows_out"] += rows_out
+
+    def reset(self):
+        self.stages = {}
+
+    def report(self) -> list[dict]:
+        # One entry per stage in the order they first ran, with throughput and share of the total time
+        total = sum(stats["seconds"] for stats in self.stages.values())
+        return [
+            {
+                "stage": stage,
+                **stats,
+                "rows_per_second": stats["rows_in"] / stats["seconds"] if stats["seconds"] else 0.0,
+                "share": stats["seconds"] / total if total else 0.0,
+            }
+            for stage, stats in self.stages.items()
+        ]
+
+    def print_report(self):
+        for stats in self.report():
+            print(f"{stats['stage']}: {stats['seconds']:.2f}s ({stats['share']:.0%}) in {stats['calls']} call(s), "
+                  f"{stats['rows_in']} -> {stats['rows_out']} rows, {stats['rows_per_second']:.1f} rows/s")
+
+class StageTimer(pt.Transformer):
+    # Runs the wrapped transformer and records its wall time and input/output rows in a PipelineProfile
+    def __init__(self, transformer: pt.Transformer, stage: str, profile: PipelineProfile):
+        self.transformer = transformer
+        self.stage = stage
+        self.profile = profile
+
+    def __repr__(self):
+        return f"StageTimer({self.transformer!r})"
+
+    def transform(self, inp: pd.DataFrame) -> pd.DataFrame:
+        start = time.perf_counter()
+        out = self.transformer.transform(inp)
+        self.profile.record(self.stage, time.perf_counter() - start, len(inp), len(out))
+        return out
+
+def instrument(pipeline: pt.Transformer, profile: PipelineProfile | None, name="pipeline") -> pt.Transformer:
+    # Every stage of a >> pipeline wrapped in a StageTimer, recorded as "<name> [i] <stage>".
+    # Without a profile the pipeline is returned untouched, so disabled instrumentation costs nothing
+    if profile is None:
+        return pipeline
+    stages = list(pipeline) if isinstance(pipeline, pt.Compose) else [pipeline]
+    timed = [StageTimer(stage, f"{name} [{i}] {str(stage)[:60]}", profile) for i, stage in enumerate(stages)]
+    return pt.Compose(*timed) if len(timed) > 1 else timed[0]